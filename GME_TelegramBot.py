@@ -6,17 +6,44 @@ import logging
 import sqlite3
 import requests
 import random
+import shutil
+import socket
 import math  # mettilo in cima al file con gli altri import
+import re
 import asyncio
+import argparse
+import atexit
+import contextvars
+import copy
+import bisect
+import csv
+import gzip
+import hashlib
+import html
+import io
+import json
+import queue
+import sys
+import tempfile
+import threading
+import traceback
+from array import array
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, time, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from urllib.parse import urlparse
+from time import perf_counter, sleep
 from zoneinfo import ZoneInfo
 
 from dotenv import load_dotenv
 from flask import Flask
 from telegram import Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, TelegramError
 from telegram.ext import (
+    ApplicationHandlerStop,
+    TypeHandler,
     Application,
     CommandHandler,
     ContextTypes,
@@ -25,24 +52,258 @@ from telegram.ext import (
 
 # ---------------------- CONFIG ----------------------
 load_dotenv()
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 
 START_TIME = time(0, 0)
 CUTOFF_TIME = time(15, 30)
 MARKET_CLOSE_TIME = time(22, 10)
+# Tetto per /bet: sopra qualsiasi variazione sensata ma con margine sui valori storici.
+MAX_PREDICTION = 100000
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 API_KEY = os.getenv("FINNHUB_API_KEY")
+FINNHUB_BASE_URL = os.getenv("FINNHUB_BASE_URL", "https://finnhub.io/api/v1").rstrip("/")
 GME_TICKER = "GME"
 
 GROUP_TOPIC_CHAT_ID = -1001425180088
 ITALY_TZ = ZoneInfo("Europe/Rome")
 ADMIN_CHAT_ID = 68001743
 
+# Regole di punteggio iniziali (versione 1 in scoring_rules).
+DEFAULT_SCORING_RULES = {
+    "rewards": [150, 100, 50],        # 1°, 2°, 3° classificato
+    "penalties": [-150, -100, -50],   # ultimo, penultimo, terzultimo
+    "risk_multiplier": 5,
+    "perfect_guess_prize": 300,
+    "non_bettor_penalty": 10,
+}
+
 CHIUSURE_MERCATO = {
     "2026-01-01", "2026-04-03", "2026-05-25", "2026-06-19", "2026-01-19", "2026-02-16", "2026-06-19", "2026-07-03", "2026-09-07", "2026-11-26", "2026-12-25"
 }
 
+# ---------------------- LOGGING ----------------------
+# I record passano da una coda: chi logga (anche il loop asyncio) non scrive mai su
+# file o terminale, lo fa il thread del QueueListener. Ogni update gestito produce un
+# record con update_id, chat_id, comando, durata e tempo speso su SQLite e Finnhub.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")          # json | text
+LOG_FILE = os.getenv("LOG_FILE")                      # se vuoto: solo stderr
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_SECONDS", "2"))
+
+_update_context = contextvars.ContextVar("update_context", default=None)
+
+
+def add_timing(key, seconds):
+    """Somma seconds (db_ms / upstream_ms) al contesto dell'update in corso, se c'è."""
+    ctx = _update_context.get()
+    if ctx is not None:
+        ctx[key] = ctx.get(key, 0.0) + seconds * 1000
+
+
+class _ContextFilter(logging.Filter):
+    # Gira nel thread di chi logga, prima della coda: lì il contesto è ancora visibile.
+    def filter(self, record):
+        ctx = _update_context.get()
+        if ctx is not None:
+            record.update_context = {k: ctx[k] for k in ("update_id", "chat_id", "user_id", "command") if k in ctx}
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "update_context", None) or {})
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s - %(levelname)s - %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        extra = {**(getattr(record, "update_context", None) or {}), **(getattr(record, "fields", None) or {})}
+        extra.pop("stack", None)
+        if extra:
+            line += " " + " ".join(f"{k}={v}" for k, v in extra.items())
+        stack = (getattr(record, "fields", None) or {}).get("stack")
+        return f"{line}\n{stack}" if stack else line
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # La coda resta nello stesso processo: il messaggio viene fissato subito, ma exc_info
+        # e stack_info arrivano intatti al formatter del listener (campi exc/stack nel JSON).
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+
+def setup_logging():
+    """Configura il logging: QueueHandler sul root logger, output su stderr o file a rotazione."""
+    if LOG_FILE:
+        target = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, target, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+setup_logging()
+
+
+_inflight = {}
+
+
+def _slow_handler_watch():
+    """Thread unico: campiona lo stack degli handler che superano SLOW_HANDLER_SECONDS (una volta sola)."""
+    interval = min(0.5, SLOW_HANDLER_SECONDS / 4)
+    while True:
+        sleep(interval)
+        now = perf_counter()
+        for key, item in list(_inflight.items()):
+            start, ctx, thread_id, task = item
+            if now - start < SLOW_HANDLER_SECONDS or _inflight.pop(key, None) is None:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            if task is not None and not task.done():
+                buffer = io.StringIO()
+                task.print_stack(file=buffer)
+                stack += buffer.getvalue()
+            logging.warning(
+                f"Handler /{ctx['command']} lento: oltre {SLOW_HANDLER_SECONDS}s",
+                extra={"fields": {**ctx, "elapsed_ms": round((now - start) * 1000, 2), "stack": stack}},
+            )
+
+
+def instrument_handler(command, callback):
+    """Avvolge un handler: contesto di log per l'update, durata e campione dello stack se lento."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        ctx = {
+            "update_id": update.update_id,
+            "chat_id": update.effective_chat.id if update.effective_chat else None,
+            "user_id": update.effective_user.id if update.effective_user else None,
+            "command": command,
+        }
+        token = _update_context.set(ctx)
+        key = object()
+        start = perf_counter()
+        _inflight[key] = (start, dict(ctx), threading.get_ident(), asyncio.current_task())
+        try:
+            return await callback(update, context)
+        finally:
+            _inflight.pop(key, None)
+            logging.info(f"Update gestito: /{command}", extra={"fields": {
+                "duration_ms": round((perf_counter() - start) * 1000, 2),
+                "db_ms": round(ctx.get("db_ms", 0.0), 2),
+                "upstream_ms": round(ctx.get("upstream_ms", 0.0), 2),
+            }})
+            _update_context.reset(token)
+
+    return wrapper
+
+
+def timed_get(url, **kwargs):
+    """requests.get che conta il tempo speso verso servizi esterni nel contesto dell'update."""
+    start = perf_counter()
+    try:
+        return requests.get(url, **kwargs)
+    finally:
+        add_timing("upstream_ms", perf_counter() - start)
+
+# ---------------------- WATCHDOG ----------------------
+# Un task fa da battito cardiaco sul loop e misura di quanto si sveglia in ritardo;
+# un thread separato si accorge se il battito si ferma oltre WATCHDOG_THRESHOLD_MS,
+# campiona lo stack del thread del loop (cioè la chiamata bloccante) e lo registra
+# insieme all'handler in corso. I percentili del ritardo sono esposti su /health.
+WATCHDOG_INTERVAL = 0.25
+WATCHDOG_THRESHOLD_MS = float(os.getenv("WATCHDOG_THRESHOLD_MS", "500"))
+WATCHDOG_STALL_SECONDS = 60       # oltre questo /health risponde 503
+WATCHDOG_SAMPLES = 1200           # ~5 minuti di battiti
+
+_loop_lag_ms = deque(maxlen=WATCHDOG_SAMPLES)
+_watchdog = {"last_beat": None, "thread_id": None, "stalls": 0}
+
+
+async def loop_heartbeat():
+    loop = asyncio.get_running_loop()
+    _watchdog["thread_id"] = threading.get_ident()
+    threading.Thread(target=_watchdog_monitor, name="loop-watchdog", daemon=True).start()
+    while True:
+        expected = loop.time() + WATCHDOG_INTERVAL
+        _watchdog["last_beat"] = perf_counter()
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        _loop_lag_ms.append(max(0.0, (loop.time() - expected) * 1000))
+
+
+def _current_handler():
+    for _, ctx, _, task in list(_inflight.values()):
+        if task is not None and task.get_coro().cr_running:
+            return ctx
+    return None
+
+
+def _watchdog_monitor():
+    reported_beat = None
+    while True:
+        sleep(WATCHDOG_INTERVAL / 2)
+        last_beat = _watchdog["last_beat"]
+        if last_beat is None or last_beat == reported_beat:
+            continue
+        blocked_ms = (perf_counter() - last_beat) * 1000 - WATCHDOG_INTERVAL * 1000
+        if blocked_ms < WATCHDOG_THRESHOLD_MS:
+            continue
+        reported_beat = last_beat
+        _watchdog["stalls"] += 1
+        frame = sys._current_frames().get(_watchdog["thread_id"])
+        ctx = _current_handler() or {}
+        logging.warning(
+            f"Loop bloccato da oltre {blocked_ms:.0f} ms (handler: {ctx.get('command', '-')})",
+            extra={"fields": {
+                **ctx,
+                "blocked_ms": round(blocked_ms, 1),
+                "stack": "".join(traceback.format_stack(frame)) if frame is not None else "",
+            }},
+        )
+
+
+def loop_lag_report():
+    samples = sorted(_loop_lag_ms)
+    last_beat = _watchdog["last_beat"]
+    report = {
+        "samples": len(samples),
+        "stalls": _watchdog["stalls"],
+        "last_beat_ms": round((perf_counter() - last_beat) * 1000, 1) if last_beat else None,
+    }
+    if samples:
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            report[f"lag_{name}_ms"] = round(samples[min(len(samples) - 1, int(q * len(samples)))], 2)
+        report["lag_max_ms"] = round(samples[-1], 2)
+    return report
+
 # ---------------------- FLASK (UNICO) ----------------------
 app = Flask(__name__)
 
@@ -52,11 +313,12 @@ def home():
 
 @app.route("/health")
 def health():
-    return "ok", 200
+    loop = loop_lag_report()
+    stalled = loop["last_beat_ms"] is not None and loop["last_beat_ms"] > WATCHDOG_STALL_SECONDS * 1000
+    return {"status": "stalled" if stalled else "ok", "loop": loop}, 503 if stalled else 200
 
 def start_keep_alive_server():
     port = int(os.environ.get("PORT", "8080"))  # su Render è 8080
-    import threading
     t = threading.Thread(target=lambda: app.run(host="0.0.0.0", port=port), daemon=True)
     t.start()
     logging.info(f"Keep-alive server started on port {port}")
@@ -71,65 +333,178 @@ async def keep_alive_ping():
     logging.info(f"Keep-alive ping attivo verso {url}")
     while True:
         try:
-            await asyncio.to_thread(requests.get, url, timeout=5)
-            logging.debug("Keep-alive ping inviato con successo")
+            if is_leader():
+                await asyncio.to_thread(requests.get, url, timeout=5)
+                logging.debug("Keep-alive ping inviato con successo")
         except Exception as exc:
             logging.warning(f"Errore durante il keep-alive ping: {exc}")
         await asyncio.sleep(180)
 
 # ---------------------- DATABASE ----------------------
-DB_FILE = "predictions.db"
+DB_FILE = os.getenv("PREDICTIONS_DB", "predictions.db")
 DB_UPDATES_DIR = Path(__file__).resolve().parent / "db_updates"
 
 
-def apply_text_db_updates(connection):
-    """Apply each SQL update file once, tracking applied scripts in the DB."""
+def split_sql_statements(script):
+    """Divide uno script SQL in istruzioni complete (i ';' dentro le stringhe non contano)."""
+    statements, buffer = [], ""
+    for part in script.split(";"):
+        buffer += part + ";"
+        if sqlite3.complete_statement(buffer):
+            if buffer.strip(" \t\r\n;"):
+                statements.append(buffer.strip())
+            buffer = ""
+    if buffer.strip(" \t\r\n;"):
+        statements.append(buffer.rstrip(";").strip())
+    return statements
+
+
+def _balances_snapshot(connection):
+    return {uid: (uname, bal) for uid, uname, bal in connection.execute("SELECT user_id, username, balance FROM balances")}
+
+
+def apply_db_migrations(connection, dry_run=False):
+    """Applica una volta sola ogni script in db_updates, ciascuno in una transazione esplicita.
+
+    Gli script già applicati vengono riconosciuti con un'unica query e, se dimensione e
+    mtime non sono cambiati, non vengono nemmeno riletti; se il contenuto è cambiato dopo
+    l'applicazione il checksum lo segnala senza rieseguirlo.
+    Con dry_run=True gli script in attesa vengono eseguiti in ordine e poi annullati tutti
+    insieme, e si ritorna {filename: [(user_id, username, saldo_prima, saldo_dopo), ...]}
+    con i saldi prima e dopo ciascuno script.
+    """
     connection.execute("""
         CREATE TABLE IF NOT EXISTS applied_db_updates (
             filename TEXT PRIMARY KEY,
             applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(applied_db_updates)")}
+    for column, kind in (("checksum", "TEXT"), ("size", "INTEGER"), ("mtime_ns", "INTEGER")):
+        if column not in columns:
+            connection.execute(f"ALTER TABLE applied_db_updates ADD COLUMN {column} {kind}")
+    connection.commit()
 
+    report = {}
     if not DB_UPDATES_DIR.exists():
-        connection.commit()
-        return
+        return report
 
-    for sql_path in sorted(DB_UPDATES_DIR.glob("*.sql")):
-        filename = sql_path.name
-        already_applied = connection.execute(
-            "SELECT 1 FROM applied_db_updates WHERE filename = ?",
-            (filename,),
-        ).fetchone()
-        if already_applied:
-            logging.info(f"Skipping already applied DB update script: {filename}")
-            continue
+    applied = {
+        filename: (checksum, size, mtime_ns)
+        for filename, checksum, size, mtime_ns in connection.execute(
+            "SELECT filename, checksum, size, mtime_ns FROM applied_db_updates"
+        )
+    }
 
-        script = sql_path.read_text(encoding="utf-8").strip()
-        if not script:
-            connection.execute(
-                "INSERT INTO applied_db_updates (filename) VALUES (?)",
-                (filename,),
-            )
-            logging.info(f"Marked empty DB update script as applied: {filename}")
-            continue
+    if connection.in_transaction:
+        connection.commit()
+    if dry_run:
+        # Gli script in attesa girano tutti in ordine dentro un unico savepoint, annullato
+        # alla fine: ciascuno vede le modifiche dei precedenti, come in un'esecuzione reale.
+        connection.execute("SAVEPOINT db_dry_run")
+    try:
+        for sql_path in sorted(DB_UPDATES_DIR.glob("*.sql")):
+            filename = sql_path.name
+            stat = sql_path.stat()
+            recorded = applied.get(filename)
+            if recorded and recorded[1:] == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            raw = sql_path.read_bytes()
+            checksum = hashlib.sha256(raw).hexdigest()
+            if recorded:
+                if recorded[0] is not None and recorded[0] != checksum:
+                    logging.warning(f"Script DB già applicato ma modificato in seguito, non rieseguito: {filename}")
+                    continue
+                if not dry_run:
+                    connection.execute(
+                        "UPDATE applied_db_updates SET checksum = ?, size = ?, mtime_ns = ? WHERE filename = ?",
+                        (checksum, stat.st_size, stat.st_mtime_ns, filename),
+                    )
+                    connection.commit()
+                continue
+
+            statements = split_sql_statements(raw.decode("utf-8"))
+            if connection.in_transaction and not dry_run:
+                connection.commit()
+            before = _balances_snapshot(connection) if dry_run else None
+            connection.execute("SAVEPOINT db_update")
+            try:
+                for statement in statements:
+                    connection.execute(statement)
+                if dry_run:
+                    after = _balances_snapshot(connection)
+                    report[filename] = [
+                        (uid, (after.get(uid) or before.get(uid))[0],
+                         before.get(uid, (None, None))[1], after.get(uid, (None, None))[1])
+                        for uid in sorted(before.keys() | after.keys())
+                        if before.get(uid, (None, None))[1] != after.get(uid, (None, None))[1]
+                    ]
+                else:
+                    connection.execute(
+                        "INSERT INTO applied_db_updates (filename, checksum, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                        (filename, checksum, stat.st_size, stat.st_mtime_ns),
+                    )
+                connection.execute("RELEASE db_update")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK TO db_update")
+                connection.execute("RELEASE db_update")
+                logging.error(f"Script DB annullato per errore: {filename}")
+                raise
+            if not dry_run:
+                logging.info(f"Applied DB update script: {filename} ({len(statements)} statements)")
+    finally:
+        if dry_run:
+            connection.execute("ROLLBACK TO db_dry_run")
+            connection.execute("RELEASE db_dry_run")
+
+    return report
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor che somma il tempo delle query al contesto dell'update in corso."""
+
+    def execute(self, *args):
+        start = perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            add_timing("db_ms", perf_counter() - start)
 
+    def executemany(self, *args):
+        start = perf_counter()
         try:
-            connection.executescript(script)
-            connection.execute(
-                "INSERT INTO applied_db_updates (filename) VALUES (?)",
-                (filename,),
-            )
-            connection.commit()
-            logging.info(f"Applied DB update script: {filename}")
-        except sqlite3.Error:
-            connection.rollback()
-            raise
+            return super().executemany(*args)
+        finally:
+            add_timing("db_ms", perf_counter() - start)
 
-    connection.commit()
+    def fetchall(self):
+        start = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            add_timing("db_ms", perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
 
+    def execute(self, *args):
+        return self.cursor().execute(*args)
 
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = perf_counter()
+        try:
+            return super().commit()
+        finally:
+            add_timing("db_ms", perf_counter() - start)
+
+
+conn = sqlite3.connect(DB_FILE, check_same_thread=False, factory=TimedConnection)
 c = conn.cursor()
 conn.execute("PRAGMA journal_mode=WAL;")
 conn.execute("PRAGMA busy_timeout=5000;")
@@ -168,31 +543,344 @@ c.execute("""
         amount REAL DEFAULT 0
     )
 """)
+c.execute("""
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        bets INTEGER NOT NULL DEFAULT 0,
+        abs_error_sum REAL NOT NULL DEFAULT 0,
+        best_error REAL,
+        wins INTEGER NOT NULL DEFAULT 0,
+        streak INTEGER NOT NULL DEFAULT 0,
+        last_date TEXT,
+        balance_high REAL,
+        balance_low REAL
+    )
+""")
+c.execute("CREATE INDEX IF NOT EXISTS idx_user_stats_username ON user_stats(username)")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS results (
+        date TEXT PRIMARY KEY,
+        closing_percentage REAL NOT NULL,
+        perfect_user_id INTEGER,
+        variable_pool REAL NOT NULL DEFAULT 0,
+        pot_before REAL NOT NULL DEFAULT 0,
+        pot_awarded REAL NOT NULL DEFAULT 0,
+        non_bettor_penalty REAL NOT NULL DEFAULT 0,
+        settled_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+""")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS result_entries (
+        date TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        prediction REAL,
+        diff REAL,
+        rank INTEGER,
+        fixed REAL NOT NULL DEFAULT 0,
+        variable REAL NOT NULL DEFAULT 0,
+        pot REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (date, user_id)
+    )
+""")
+c.execute("CREATE INDEX IF NOT EXISTS idx_result_entries_user_date ON result_entries(user_id, date)")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS scoring_rules (
+        version INTEGER PRIMARY KEY,
+        rules TEXT NOT NULL,
+        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+""")
+c.execute("INSERT OR IGNORE INTO scoring_rules (version, rules) VALUES (1, ?)", (json.dumps(DEFAULT_SCORING_RULES),))
+if "rules_version" not in {row[1] for row in c.execute("PRAGMA table_info(results)")}:
+    c.execute("ALTER TABLE results ADD COLUMN rules_version INTEGER NOT NULL DEFAULT 1")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        date TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        balance REAL,
+        PRIMARY KEY (date, user_id)
+    )
+""")
+c.execute("CREATE INDEX IF NOT EXISTS idx_predictions_date ON predictions(date)")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS pot_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        week_start TEXT NOT NULL,
+        date TEXT,
+        kind TEXT NOT NULL CHECK (kind IN ('contribution', 'rollover', 'award', 'adjustment')),
+        amount REAL NOT NULL,
+        user_id INTEGER,
+        note TEXT,
+        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+""")
+c.execute("CREATE INDEX IF NOT EXISTS idx_pot_ledger_week ON pot_ledger(week_start)")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS pot_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total REAL NOT NULL DEFAULT 0,
+        week_start TEXT,
+        syncing INTEGER NOT NULL DEFAULT 0
+    )
+""")
+if "syncing" not in {row[1] for row in c.execute("PRAGMA table_info(pot_state)")}:
+    c.execute("ALTER TABLE pot_state ADD COLUMN syncing INTEGER NOT NULL DEFAULT 0")
+# Il totale è mantenuto dal trigger: le righe "rollover" documentano il riporto
+# del tesoretto a una nuova settimana e non cambiano il totale.
+c.execute("""
+    CREATE TRIGGER IF NOT EXISTS pot_ledger_total AFTER INSERT ON pot_ledger
+    WHEN NEW.kind <> 'rollover'
+    BEGIN
+        UPDATE pot_state SET
+            total = ROUND(total + NEW.amount, 2),
+            week_start = MAX(COALESCE(week_start, NEW.week_start), NEW.week_start)
+        WHERE id = 1;
+    END
+""")
+if c.execute("SELECT 1 FROM pot_state").fetchone() is None:
+    c.execute("INSERT INTO pot_state (id, total) VALUES (1, 0)")
+    c.execute("""
+        INSERT INTO pot_ledger (week_start, kind, amount, note)
+        SELECT week_start, 'contribution', amount, 'saldo iniziale da weekly_pot'
+        FROM weekly_pot WHERE amount <> 0 ORDER BY week_start
+    """)
+# weekly_pot resta per gli script in db_updates/, che la trattano come valore assoluto del
+# tesoretto (DELETE delle settimane superate + upsert). Il bot la tiene allineata al registro
+# (contributi sommati, svuotata all'assegnazione) e ogni modifica esterna diventa una rettifica
+# pari a SUM(weekly_pot) - totale. Le scritture del bot impostano pot_state.syncing, che
+# disattiva i trigger: con più righe (riporto) ogni riga cancellata farebbe una rettifica.
+for event in ("insert", "update", "delete"):
+    c.execute(f"DROP TRIGGER IF EXISTS weekly_pot_{event}")
+if c.execute("""
+    SELECT ROUND(COALESCE((SELECT SUM(amount) FROM weekly_pot), 0), 2) <> ROUND(total, 2)
+    FROM pot_state WHERE id = 1
+""").fetchone()[0]:
+    c.execute("DELETE FROM weekly_pot")
+    c.execute("""
+        INSERT INTO weekly_pot (week_start, amount)
+        SELECT week_start, total FROM pot_state WHERE id = 1 AND week_start IS NOT NULL AND total <> 0
+    """)
+for event, ref in (("INSERT", "NEW"), ("UPDATE OF amount", "NEW"), ("DELETE", "OLD")):
+    c.execute(f"""
+        CREATE TRIGGER weekly_pot_{event.split()[0].lower()} AFTER {event} ON weekly_pot
+        WHEN (SELECT syncing FROM pot_state WHERE id = 1) = 0
+        BEGIN
+            INSERT INTO pot_ledger (week_start, kind, amount, note)
+            SELECT {ref}.week_start, 'adjustment', diff, 'weekly_pot'
+            FROM (
+                SELECT ROUND(COALESCE((SELECT SUM(amount) FROM weekly_pot), 0) - total, 2) AS diff
+                FROM pot_state WHERE id = 1
+            )
+            WHERE diff <> 0;
+        END
+    """)
+c.execute("""
+    CREATE TABLE IF NOT EXISTS gme_closes (
+        date TEXT PRIMARY KEY,
+        closing_percentage REAL NOT NULL,
+        source TEXT NOT NULL,
+        fetched_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+""")
+c.execute("""
+    CREATE TABLE IF NOT EXISTS scoreboards (
+        chat_id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL,
+        thread_id INTEGER
+    )
+""")
 conn.commit()
-apply_text_db_updates(conn)
 
 
-def get_unassigned_pot(week_start):
-    c.execute("SELECT COALESCE(SUM(amount), 0) FROM weekly_pot WHERE week_start <= ?", (week_start,))
-    return round(c.fetchone()[0] or 0.0, 2)
+def get_unassigned_pot():
+    c.execute("SELECT total FROM pot_state WHERE id = 1")
+    row = c.fetchone()
+    return round(row[0], 2) if row else 0.0
+
 
+def _sync_weekly_pot(sql, params=()):
+    """Scrittura del bot su weekly_pot, già registrata nel registro: nessuna rettifica."""
+    c.execute("UPDATE pot_state SET syncing = 1 WHERE id = 1")
+    c.execute(sql, params)
+    c.execute("UPDATE pot_state SET syncing = 0 WHERE id = 1")
 
-def clear_unassigned_pot(week_start):
-    c.execute("DELETE FROM weekly_pot WHERE week_start <= ?", (week_start,))
+
+def add_pot_contribution(week_start, date, amount):
+    """Aggiunge le penalità della giornata al tesoretto, registrando l'eventuale riporto."""
+    if amount == 0:
+        return
+    c.execute("SELECT total, week_start FROM pot_state WHERE id = 1")
+    total, current_week = c.fetchone()
+    if total and current_week and current_week < week_start:
+        c.execute("""
+            INSERT INTO pot_ledger (week_start, date, kind, amount, note)
+            VALUES (?, ?, 'rollover', ?, ?)
+        """, (week_start, date, total, f"riportato dalla settimana del {current_week}"))
+    c.execute("""
+        INSERT INTO pot_ledger (week_start, date, kind, amount)
+        VALUES (?, ?, 'contribution', ?)
+    """, (week_start, date, amount))
+    _sync_weekly_pot("""
+        INSERT INTO weekly_pot (week_start, amount) VALUES (?, ?)
+        ON CONFLICT(week_start) DO UPDATE SET amount = ROUND(amount + excluded.amount, 2)
+    """, (week_start, amount))
+
+
+def award_pot(week_start, date, user_id):
+    """Assegna l'intero tesoretto a user_id e lo azzera; ritorna l'importo assegnato."""
+    amount = get_unassigned_pot()
+    if amount:
+        c.execute("""
+            INSERT INTO pot_ledger (week_start, date, kind, amount, user_id)
+            VALUES (?, ?, 'award', ?, ?)
+        """, (week_start, date, -amount, user_id))
+        _sync_weekly_pot("DELETE FROM weekly_pot")
+    return amount
+
+
+def get_pot_history(limit=20):
+    c.execute("""
+        SELECT l.week_start, l.date, l.kind, l.amount, b.username, l.note
+        FROM pot_ledger l LEFT JOIN balances b ON b.user_id = l.user_id
+        ORDER BY l.id DESC LIMIT ?
+    """, (limit,))
+    return c.fetchall()[::-1]
+
+
+# ---------------------- STATISTICHE UTENTI ----------------------
+# user_stats contiene aggregati già pronti: /stats è una lettura per chiave primaria
+# e la settlement li aggiorna in modo incrementale.
+# "Vittoria" = 1° per distanza dal valore reale; "serie" = giornate consecutive
+# (tra quelle giocate) chiuse nella metà alta della classifica giornaliera.
+
+def _stats_rows(target_date, players):
+    """players: lista (user_id, username, prediction, diff) già ordinata per diff."""
+    half = len(players) // 2
+    return [
+        (uid, uname, diff, diff, 1 if rank == 1 else 0, 1 if rank <= half else 0, target_date)
+        for rank, (uid, uname, _, diff) in enumerate(players, start=1)
+    ]
+
+
+def update_balance_watermarks():
+    c.execute("""
+        INSERT INTO user_stats (user_id, username, balance_high, balance_low)
+        SELECT user_id, username, balance, balance FROM balances WHERE true
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance_high = MAX(COALESCE(balance_high, excluded.balance_high), excluded.balance_high),
+            balance_low = MIN(COALESCE(balance_low, excluded.balance_low), excluded.balance_low)
+    """)
+
+
+def update_user_stats(target_date, players):
+    """Aggiorna gli aggregati dopo la settlement di target_date (nella stessa transazione)."""
+    c.executemany("""
+        INSERT INTO user_stats (user_id, username, bets, abs_error_sum, best_error, wins, streak, last_date)
+        VALUES (?, ?, 1, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            bets = bets + 1,
+            abs_error_sum = ROUND(abs_error_sum + excluded.abs_error_sum, 4),
+            best_error = MIN(COALESCE(best_error, excluded.best_error), excluded.best_error),
+            wins = wins + excluded.wins,
+            streak = CASE WHEN excluded.streak > 0 THEN streak + 1 ELSE 0 END,
+            last_date = excluded.last_date
+        WHERE last_date IS NULL OR last_date <> excluded.last_date
+    """, _stats_rows(target_date, players))
+    update_balance_watermarks()
+
+
+def _settled_closes():
+    """Chiusure delle date già calcolate: da results, o dai vecchi messaggi HTML in winners."""
+    closes = {}
+    c.execute("SELECT date, result FROM winners")
+    for date, result in c.fetchall():
+        match = re.search(r"Variazione GME \(\d{4}-\d{2}-\d{2}\): (-?\d+(?:\.\d+)?)%", result or "")
+        if match:
+            closes[date] = float(match.group(1))
+    c.execute("SELECT date, closing_percentage FROM results")
+    closes.update(c.fetchall())
+    return closes
+
+
+def rebuild_user_stats():
+    """Ricalcola da zero tutti gli aggregati con una sola passata sulle previsioni."""
+    closes = _settled_closes()
+    acc = {}
+
+    def flush(day, rows):
+        players = sorted(
+            ((uid, uname, pred, round(abs(pred - closes[day]), 2)) for uid, uname, pred in rows),
+            key=lambda x: x[3],
+        )
+        for uid, uname, diff, _, win, top, _ in _stats_rows(day, players):
+            st = acc.setdefault(uid, [uname, 0, 0.0, None, 0, 0, day])
+            st[0] = uname
+            st[1] += 1
+            st[2] += diff
+            st[3] = diff if st[3] is None else min(st[3], diff)
+            st[4] += win
+            st[5] = st[5] + 1 if top else 0
+            st[6] = day
+
+    current_day, rows = None, []
+    cursor = conn.execute("SELECT date, user_id, username, prediction FROM predictions ORDER BY date")
+    for day, uid, uname, pred in cursor:
+        if day not in closes:
+            continue
+        if day != current_day and rows:
+            flush(current_day, rows)
+            rows = []
+        current_day = day
+        rows.append((uid, uname, pred))
+    if rows:
+        flush(current_day, rows)
+
+    c.execute("DELETE FROM user_stats")
+    c.executemany("""
+        INSERT INTO user_stats (user_id, username, bets, abs_error_sum, best_error, wins, streak, last_date)
+        VALUES (?, ?, ?, ROUND(?, 4), ?, ?, ?, ?)
+    """, [(uid, *st) for uid, st in acc.items()])
+    # Massimi e minimi dai saldi salvati a ogni giornata, poi il saldo attuale.
+    c.execute("""
+        INSERT INTO user_stats (user_id, username, balance_high, balance_low)
+        SELECT user_id, username, MAX(balance), MIN(balance) FROM balance_snapshots
+        WHERE true GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance_high = excluded.balance_high,
+            balance_low = excluded.balance_low
+    """)
+    update_balance_watermarks()
+    conn.commit()
+    return len(acc), len(closes)
 
 # ---------------------- DATI GME ----------------------
-def get_gme_closing_percentage():
-    url = f"https://finnhub.io/api/v1/quote?symbol={GME_TICKER}&token={API_KEY}"
+US_MARKET_TZ = ZoneInfo("America/New_York")
+US_MARKET_OPEN = time(9, 30)
+US_MARKET_CLOSE = time(16, 0)
+
+
+def get_gme_quote():
+    """Quotazione corrente: (variazione %, timestamp unix della quotazione) oppure None."""
+    url = f"{FINNHUB_BASE_URL}/quote?symbol={GME_TICKER}&token={API_KEY}"
     try:
-        data = requests.get(url, timeout=10).json()
+        data = timed_get(url, timeout=10).json()
         pc, cprice = data.get("pc"), data.get("c")
-        if pc is None or cprice is None:
+        if pc in (None, 0) or cprice is None:
             return None
-        return round(((cprice - pc) / pc) * 100, 2)
+        return round(((cprice - pc) / pc) * 100, 2), data.get("t")
     except Exception as e:
         logging.error(f"Errore Finnhub: {e}")
         return None
 
+
+def get_gme_closing_percentage():
+    quote = get_gme_quote()
+    return quote[0] if quote else None
+
 def _unix_timestamp(date_obj):
     return int(datetime.combine(date_obj, time.min, tzinfo=timezone.utc).timestamp())
 
@@ -201,13 +889,13 @@ def _get_gme_historical_closing_percentage(target_date):
     start_date = target_date - timedelta(days=10)
     end_date = target_date + timedelta(days=3)  # Use 3 days buffer to avoid timezone and settlement cutoff issues
     url = (
-        f"https://finnhub.io/api/v1/stock/candle?symbol={GME_TICKER}"
+        f"{FINNHUB_BASE_URL}/stock/candle?symbol={GME_TICKER}"
         f"&resolution=D&from={_unix_timestamp(start_date)}"
         f"&to={_unix_timestamp(end_date)}&token={API_KEY}"
     )
 
     try:
-        data = requests.get(url, timeout=10).json()
+        data = timed_get(url, timeout=10).json()
         if data.get("s") != "ok" or not data.get("t") or not data.get("c"):
             logging.warning(f"Dati candle Finnhub non disponibili per {target_date}: {data}")
             return None
@@ -248,9 +936,9 @@ def get_gme_closing_percentage_for_date(target_date):
     
     # Try Quote API first if target_date is today or yesterday (for robust live/fallback closing values)
     if target_date in (today, today - timedelta(days=1)):
-        url = f"https://finnhub.io/api/v1/quote?symbol={GME_TICKER}&token={API_KEY}"
+        url = f"{FINNHUB_BASE_URL}/quote?symbol={GME_TICKER}&token={API_KEY}"
         try:
-            data = requests.get(url, timeout=10).json()
+            data = timed_get(url, timeout=10).json()
             t = data.get("t")
             if t:
                 quote_date = datetime.fromtimestamp(t, ZoneInfo("America/New_York")).date()
@@ -269,6 +957,1040 @@ def get_gme_closing_percentage_yesterday():
     return _get_gme_historical_closing_percentage(yesterday)
 
 
+# ---------------------- REGOLE DI PUNTEGGIO ----------------------
+# Le regole sono versionate nella tabella scoring_rules; ogni riga di results registra
+# la versione usata, così i risultati passati restano riproducibili.
+
+class SettlementPlan:
+    """Regole compilate una volta per versione e applicate da compute_settlement."""
+
+    __slots__ = ("version", "rewards", "penalties", "risk_multiplier", "perfect_guess_prize", "non_bettor_penalty")
+
+    def __init__(self, version, rules):
+        self.version = version
+        self.rewards = tuple(rules["rewards"])
+        self.penalties = tuple(rules["penalties"])
+        self.risk_multiplier = rules["risk_multiplier"]
+        self.perfect_guess_prize = rules["perfect_guess_prize"]
+        self.non_bettor_penalty = rules["non_bettor_penalty"]
+
+
+_settlement_plans = {}
+
+
+def normalize_rules(overrides, base=None):
+    """Unisce overrides alle regole base, validando chiavi e tipi (ValueError se non validi)."""
+    rules = dict(base or DEFAULT_SCORING_RULES)
+    for key, value in overrides.items():
+        if key not in DEFAULT_SCORING_RULES:
+            raise ValueError(f"Regola sconosciuta: {key}")
+        if isinstance(DEFAULT_SCORING_RULES[key], list):
+            if not isinstance(value, list) or not all(isinstance(v, (int, float)) for v in value):
+                raise ValueError(f"{key} deve essere una lista di numeri")
+        elif not isinstance(value, (int, float)):
+            raise ValueError(f"{key} deve essere un numero")
+        rules[key] = value
+    return rules
+
+
+def get_settlement_plan(version=None):
+    """Piano per la versione richiesta (default: la più recente), compilato una volta sola."""
+    if version is None:
+        c.execute("SELECT MAX(version) FROM scoring_rules")
+        version = c.fetchone()[0]
+    if version not in _settlement_plans:
+        c.execute("SELECT rules FROM scoring_rules WHERE version = ?", (version,))
+        row = c.fetchone()
+        if row is None:
+            raise ValueError(f"Versione regole inesistente: {version}")
+        _settlement_plans[version] = SettlementPlan(version, normalize_rules(json.loads(row[0])))
+    return _settlement_plans[version]
+
+
+def add_scoring_rules(overrides):
+    """Registra una nuova versione delle regole (a partire dalla più recente) e la ritorna."""
+    current = get_settlement_plan()
+    c.execute("SELECT rules FROM scoring_rules WHERE version = ?", (current.version,))
+    rules = normalize_rules(overrides, base=normalize_rules(json.loads(c.fetchone()[0])))
+    c.execute("INSERT INTO scoring_rules (version, rules) VALUES (?, ?)", (current.version + 1, json.dumps(rules)))
+    conn.commit()
+    return get_settlement_plan(current.version + 1)
+
+
+# ---------------------- SETTLEMENT ----------------------
+RESULT_RENDER_CACHE_SIZE = 32
+STORICO_MAX_DAYS = 60
+_result_render_cache = OrderedDict()
+
+
+def compute_settlement(players, plan, pot_bonus=0.0):
+    """Calcola premi e penalità della giornata secondo plan, senza toccare il DB.
+
+    players: lista (user_id, username, prediction, diff) ordinata per diff.
+    Ritorna (perfect_uid, variable_pool, pot_winner_uid, entries) dove entries è
+    {user_id: [username, prediction, diff, rank, fisso, variabile, tesoretto]}.
+    """
+    num_players = len(players)
+    entries = {
+        uid: [uname, pred, diff, rank, 0.0, 0.0, 0.0]
+        for rank, (uid, uname, pred, diff) in enumerate(players, start=1)
+    }
+
+    perfect = next((p for p in players if p[3] == 0.0), None)
+    if perfect:
+        middle = num_players // 2
+        variable_pool = 0.0
+        for i in range(middle):
+            diff_top = players[i][3]
+            diff_bottom = players[-(i + 1)][3]
+            loss = abs(round((diff_bottom - diff_top) * plan.risk_multiplier, 2))
+            variable_pool += loss
+            entries[players[-(i + 1)][0]][5] -= loss
+
+        for i, pen in enumerate(plan.penalties[:num_players]):
+            entries[players[-(i + 1)][0]][4] += pen
+
+        pg_id = perfect[0]
+        variable_pool = round(variable_pool, 2)
+        entries[pg_id][4] += plan.perfect_guess_prize
+        entries[pg_id][5] += variable_pool
+        entries[pg_id][6] = pot_bonus
+        return pg_id, variable_pool, (pg_id if pot_bonus > 0 else None), entries
+
+    for i, reward in enumerate(plan.rewards[:num_players]):
+        entries[players[i][0]][4] += reward
+    for i, pen in enumerate(plan.penalties[:num_players]):
+        entries[players[-(i + 1)][0]][4] += pen
+
+    for i in range(num_players // 2):
+        top = players[i]
+        bottom = players[-(i + 1)]
+        delta = round((bottom[3] - top[3]) * plan.risk_multiplier, 2)
+        entries[top[0]][5] += delta
+        entries[bottom[0]][5] -= delta
+
+    if num_players % 2 == 1:
+        mid_uid = players[num_players // 2][0]
+        entries[mid_uid][4] = 0.0
+        entries[mid_uid][5] = 0.0
+
+    pot_winner = None
+    if pot_bonus > 0 and entries:
+        pot_winner = max(entries, key=lambda uid: entries[uid][4] + entries[uid][5])
+        entries[pot_winner][6] = pot_bonus
+    return None, 0.0, pot_winner, entries
+
+
+def whatif_report(date_from, date_to, overrides):
+    """Ricalcola le giornate salvate tra date_from e date_to con regole alternative.
+
+    Non modifica nulla: ritorna (giornate, [(username, effettivo, alternativo), ...]) con i
+    totali per utente di fisso + variabile + penalità da non scommettitore (tesoretto escluso).
+    Le giornate precedenti a result_entries sono ricostruite da predictions e gme_closes con
+    le regole originali (versione 1); per queste i non scommettitori non sono noti.
+    """
+    base = get_settlement_plan()
+    c.execute("SELECT rules FROM scoring_rules WHERE version = ?", (base.version,))
+    plan = SettlementPlan(0, normalize_rules(overrides, base=normalize_rules(json.loads(c.fetchone()[0]))))
+
+    totals = {}
+    days = 0
+
+    def score(rows):
+        players = [(uid, uname, pred, diff) for uid, uname, pred, diff, _, _ in rows if pred is not None]
+        _, _, _, entries = compute_settlement(players, plan)
+        for uid, uname, pred, _, fixed, variable in rows:
+            tot = totals.setdefault(uid, [uname, 0.0, 0.0])
+            tot[1] += fixed + variable
+            if pred is None:
+                tot[2] -= plan.non_bettor_penalty
+            else:
+                tot[2] += entries[uid][4] + entries[uid][5]
+
+    cursor = conn.execute("""
+        SELECT date, user_id, username, prediction, diff, fixed, variable
+        FROM result_entries
+        WHERE date BETWEEN ? AND ?
+        ORDER BY date, rank IS NULL, rank, user_id
+    """, (date_from, date_to))
+    current, rows = None, []
+    for date, *row in cursor:
+        if date != current and rows:
+            score(rows)
+            days += 1
+            rows = []
+        current = date
+        rows.append(tuple(row))
+    if rows:
+        score(rows)
+        days += 1
+
+    original = get_settlement_plan(1)
+
+    def score_legacy(bets, close):
+        players = sorted(
+            ((uid, uname, pred, round(abs(pred - close), 2)) for uid, uname, pred in bets),
+            key=lambda x: x[3],
+        )
+        _, _, _, entries = compute_settlement(players, original)
+        score([(uid, uname, pred, diff, entries[uid][4], entries[uid][5]) for uid, uname, pred, diff in players])
+
+    cursor = conn.execute("""
+        SELECT p.date, g.closing_percentage, p.user_id, p.username, p.prediction
+        FROM predictions p JOIN gme_closes g ON g.date = p.date
+        WHERE p.date BETWEEN ? AND ? AND p.date NOT IN (SELECT date FROM result_entries)
+        ORDER BY p.date, p.rowid
+    """, (date_from, date_to))
+    current, close, bets = None, None, []
+    for date, day_close, uid, uname, pred in cursor:
+        if date != current and bets:
+            score_legacy(bets, close)
+            days += 1
+            bets = []
+        current, close = date, day_close
+        bets.append((uid, uname, pred))
+    if bets:
+        score_legacy(bets, close)
+        days += 1
+
+    report = sorted(
+        ((uname, round(actual, 2), round(alt, 2)) for uname, actual, alt in totals.values()),
+        key=lambda r: r[2] - r[1],
+        reverse=True,
+    )
+    return days, report
+
+
+def settle_day(target_date, closing_percentage, predictions):
+    """Applica la settlement di target_date e salva il risultato strutturato.
+
+    Non esegue il commit: il chiamante decide se confermare o annullare.
+    """
+    date_obj = datetime.strptime(target_date, "%Y-%m-%d")
+    players = [(uid, uname, pred, round(abs(pred - closing_percentage), 2)) for uid, uname, pred in predictions]
+    players.sort(key=lambda x: x[3])
+
+    c.execute("SELECT user_id, username FROM balances")
+    all_users = dict(c.fetchall())
+    bettors_today = {p[0] for p in players}
+    non_bettors = {uid: uname for uid, uname in all_users.items() if uid not in bettors_today}
+
+    week_start = (date_obj - timedelta(days=date_obj.weekday())).strftime("%Y-%m-%d")
+    plan = get_settlement_plan()
+
+    penalty_total = plan.non_bettor_penalty * len(non_bettors)
+    c.executemany(
+        "UPDATE balances SET balance = ROUND(balance - ?, 2) WHERE user_id = ?",
+        [(plan.non_bettor_penalty, uid) for uid in non_bettors],
+    )
+    add_pot_contribution(week_start, target_date, round(penalty_total, 2))
+
+    tesoretto_val = get_unassigned_pot()
+    pot_day = date_obj.weekday() == 4 and target_date not in CHIUSURE_MERCATO and tesoretto_val > 0
+    perfect_uid, variable_pool, pot_winner, entries = compute_settlement(players, plan, tesoretto_val if pot_day else 0.0)
+
+    c.executemany("""
+        INSERT INTO balances (user_id, username, balance)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            balance = ROUND(balance + ?, 2),
+            username = excluded.username
+    """, [
+        (uid, e[0], round(e[4] + e[5], 2), round(e[4] + e[5], 2))
+        for uid, e in entries.items()
+    ])
+    if pot_winner is not None:
+        c.execute("UPDATE balances SET balance = ROUND(balance + ?, 2) WHERE user_id = ?", (tesoretto_val, pot_winner))
+        award_pot(week_start, target_date, pot_winner)
+
+    update_user_stats(target_date, players)
+
+    c.execute("""
+        INSERT INTO results (date, closing_percentage, perfect_user_id, variable_pool,
+                             pot_before, pot_awarded, non_bettor_penalty, rules_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        target_date, closing_percentage, perfect_uid, variable_pool,
+        tesoretto_val, tesoretto_val if pot_winner is not None else 0.0, plan.non_bettor_penalty, plan.version,
+    ))
+    c.executemany("""
+        INSERT INTO result_entries (date, user_id, username, prediction, diff, rank, fixed, variable, pot)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(target_date, uid, *e) for uid, e in entries.items()] + [
+        (target_date, uid, uname, None, None, None, -plan.non_bettor_penalty, 0.0, 0.0)
+        for uid, uname in non_bettors.items()
+    ])
+    c.execute("""
+        INSERT OR REPLACE INTO gme_closes (date, closing_percentage, source) VALUES (?, ?, 'settlement')
+    """, (target_date, closing_percentage))
+    c.execute("""
+        INSERT INTO balance_snapshots (date, user_id, username, balance)
+        SELECT ?, user_id, username, balance FROM balances WHERE true
+        ON CONFLICT(date, user_id) DO UPDATE SET
+            username = excluded.username,
+            balance = excluded.balance
+    """, (target_date,))
+    _result_render_cache.pop(target_date, None)
+
+
+def _render_result(target_date):
+    c.execute("""
+        SELECT closing_percentage, perfect_user_id, variable_pool, pot_before, pot_awarded,
+               non_bettor_penalty, rules_version
+        FROM results WHERE date = ?
+    """, (target_date,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    closing_percentage, perfect_uid, variable_pool, pot_before, pot_awarded, penalty, rules_version = row
+    plan = get_settlement_plan(rules_version)
+    c.execute("""
+        SELECT user_id, username, prediction, diff, rank, fixed, variable, pot
+        FROM result_entries WHERE date = ?
+        ORDER BY rank IS NULL, rank, user_id
+    """, (target_date,))
+    rows = c.fetchall()
+    players = [r for r in rows if r[4] is not None]
+    non_bettors = [r[1] for r in rows if r[4] is None]
+    num_players = len(players)
+
+    msg = f"<b>📈 Variazione GME ({target_date}): {closing_percentage}%</b>\n"
+    msg += f"<i>Tesoretto attuale: {pot_before}€</i>\n\n"
+
+    if perfect_uid is not None:
+        pg = next(p for p in players if p[0] == perfect_uid)
+        total_prize = round(plan.perfect_guess_prize + variable_pool + pg[7], 2)
+        msg += f"🎯 <b>Perfect guess!</b> @{pg[1]} ha indovinato esattamente.\n"
+        msg += f"🏅 Guadagna: {plan.perfect_guess_prize}€ + {variable_pool}€"
+        if pg[7] > 0:
+            msg += f" + {pg[7]}€ (tesoretto)"
+        msg += f" = <b>{total_prize}€</b>\n\n"
+
+        msg += "<b>📊 Partecipanti:</b>\n"
+        for uid, uname, pred, diff, *_ in players:
+            label = "🏆" if uid == perfect_uid else "•"
+            msg += f"{label} @{uname}: {pred:.2f}% (Diff: {diff:.2f}%)\n"
+
+        msg += "\n<b>❌ Perdenti (variabile):</b>\n"
+        for p in reversed(players[num_players - num_players // 2:]):
+            msg += f"• @{p[1]}: -{abs(p[6])}€\n"
+
+        msg += "\n<b>💀 Penalità fisse:</b>\n"
+        for p in reversed(players[max(0, num_players - len(plan.penalties)):]):
+            fixed = p[5] - (plan.perfect_guess_prize if p[0] == perfect_uid else 0)
+            msg += f"• @{p[1]}: {round(fixed, 2):g}€\n"
+    else:
+        ranking = sorted(players, key=lambda p: -(p[5] + p[6]))
+        for rank, (uid, uname, pred, diff, _, fisso, var, _) in enumerate(ranking, start=1):
+            total = round(fisso + var, 2)
+            label = "🏆" if rank <= len(plan.rewards) else "💀" if rank > num_players - len(plan.penalties) else "⚖️"
+            msg += (
+                f"{label} <b>{rank}°</b>: @{uname} → {pred:.2f}% "
+                f"(Diff: {diff:.2f}%) | Fisso: {fisso}€, Variabile: {var}€, Totale: {total}€\n"
+            )
+
+    if non_bettors:
+        msg += f"\n<b>😴 Non hanno scommesso e perdono {penalty:g}€:</b>\n"
+        for uname in non_bettors:
+            msg += f"• @{uname}\n"
+
+    if perfect_uid is None and pot_awarded > 0:
+        winner = next(p for p in players if p[7] > 0)
+        total_final = round(winner[5] + winner[6] + pot_awarded, 2)
+        msg += (
+            f"\n💰 Tesoretto settimanale: @{winner[1]} riceve anche <b>{pot_awarded}€</b> extra!\n"
+            f"🤑 Guadagno complessivo del giorno: <b>{total_final}€</b>\n"
+        )
+    return msg
+
+
+def render_result(target_date):
+    """Messaggio HTML della giornata, generato dalle righe di results con una piccola cache LRU."""
+    if target_date in _result_render_cache:
+        _result_render_cache.move_to_end(target_date)
+        return _result_render_cache[target_date]
+    msg = _render_result(target_date)
+    if msg is not None:
+        _result_render_cache[target_date] = msg
+        if len(_result_render_cache) > RESULT_RENDER_CACHE_SIZE:
+            _result_render_cache.popitem(last=False)
+    return msg
+
+
+# ---------------------- REPLAY ----------------------
+# Ricostruzione offline dei saldi: rigioca in memoria, in ordine cronologico, tutte le
+# giornate con previsioni usando le chiusure salvate in gme_closes (nessuna chiamata di
+# rete) e la stessa compute_settlement di /vincitore, con penalità per chi non scommette
+# e tesoretto del venerdì. Gli arrotondamenti seguono quelli fatti in SQL da settle_day.
+
+def refresh_close_cache(fetch_missing=False):
+    """Copia in gme_closes le chiusure già note; con fetch_missing scarica da Finnhub le mancanti."""
+    c.executemany(
+        "INSERT OR IGNORE INTO gme_closes (date, closing_percentage, source) VALUES (?, ?, 'settlement')",
+        _settled_closes().items(),
+    )
+    fetched, missing = 0, []
+    if fetch_missing:
+        today = datetime.now(ITALY_TZ).strftime("%Y-%m-%d")
+        c.execute("""
+            SELECT DISTINCT date FROM predictions
+            WHERE date < ? AND date NOT IN (SELECT date FROM gme_closes)
+            ORDER BY date
+        """, (today,))
+        for (date,) in c.fetchall():
+            day = datetime.strptime(date, "%Y-%m-%d").date()
+            if day.weekday() >= 5 or date in CHIUSURE_MERCATO:
+                continue
+            pct = _get_gme_historical_closing_percentage(day)
+            if pct is None:
+                missing.append(date)
+                continue
+            c.execute(
+                "INSERT INTO gme_closes (date, closing_percentage, source) VALUES (?, ?, 'finnhub')",
+                (date, pct),
+            )
+            fetched += 1
+    conn.commit()
+    return fetched, missing
+
+
+def replay_settlements(connection=None, since=None, until=None):
+    """Rigioca le giornate dopo since (saldi di partenza da balance_snapshots) fino a until.
+
+    Senza since parte da saldi e tesoretto a zero. Ritorna un dict con saldi
+    {user_id: [username, saldo]}, tesoretto, giornate rigiocate e date senza chiusura.
+    """
+    connection = connection or conn
+    balances, pot = {}, 0.0
+    if since is not None:
+        balances = {
+            uid: [uname, balance] for uid, uname, balance in connection.execute(
+                "SELECT user_id, username, balance FROM balance_snapshots WHERE date = ?", (since,)
+            )
+        }
+        row = connection.execute("SELECT pot_before - pot_awarded FROM results WHERE date = ?", (since,)).fetchone()
+        pot = round(row[0], 2) if row else 0.0
+    closes = dict(connection.execute("SELECT date, closing_percentage FROM gme_closes"))
+    versions = dict(connection.execute("SELECT date, rules_version FROM results"))
+    # Non scommettitori penalizzati da settle_day, anche se registrati dopo l'ultimo snapshot;
+    # per le giornate senza result_entries valgono i giocatori già noti al replay.
+    recorded, absent = set(), {}
+    bounds = (since or "", until or "9999-12-31")
+    for date, uid, uname, rank in connection.execute(
+        "SELECT date, user_id, username, rank FROM result_entries WHERE date > ? AND date <= ?", bounds
+    ):
+        recorded.add(date)
+        if rank is None:
+            absent.setdefault(date, []).append((uid, uname))
+    days, missing = 0, []
+
+    def settle(date, rows):
+        nonlocal pot, days
+        if date not in closes:
+            missing.append(date)
+            return
+        close = closes[date]
+        # Le giornate senza riga in results sono state calcolate con le regole originali.
+        plan = get_settlement_plan(versions.get(date, 1))
+        players = sorted(
+            ((uid, uname, pred, round(abs(pred - close), 2)) for uid, uname, pred in rows),
+            key=lambda x: x[3],
+        )
+        if date in recorded:
+            non_bettors = []
+            for uid, uname in absent.get(date, ()):
+                balances.setdefault(uid, [uname, 0.0])
+                non_bettors.append(uid)
+        else:
+            bettors = {p[0] for p in players}
+            non_bettors = [uid for uid in balances if uid not in bettors]
+        for uid in non_bettors:
+            balances[uid][1] = round(balances[uid][1] - plan.non_bettor_penalty, 2)
+        if non_bettors:
+            pot = round(pot + round(plan.non_bettor_penalty * len(non_bettors), 2), 2)
+        weekday = datetime.strptime(date, "%Y-%m-%d").weekday()
+        pot_day = weekday == 4 and date not in CHIUSURE_MERCATO and pot > 0
+        _, _, pot_winner, entries = compute_settlement(players, plan, pot if pot_day else 0.0)
+        for uid, e in entries.items():
+            entry = balances.setdefault(uid, [e[0], 0.0])
+            entry[0] = e[0]
+            entry[1] = round(entry[1] + round(e[4] + e[5], 2), 2)
+        if pot_winner is not None:
+            balances[pot_winner][1] = round(balances[pot_winner][1] + pot, 2)
+            pot = 0.0
+        days += 1
+
+    query = "SELECT date, user_id, username, prediction FROM predictions WHERE date > ? AND date <= ? ORDER BY date, rowid"
+    current, rows = None, []
+    for date, uid, uname, pred in connection.execute(query, bounds):
+        if date != current and rows:
+            settle(current, rows)
+            rows = []
+        current = date
+        rows.append((uid, uname, pred))
+    if rows:
+        settle(current, rows)
+    return {"balances": balances, "pot": pot, "days": days, "missing": missing}
+
+
+def replay_diff(replay, connection=None):
+    """Differenze tra i saldi rigiocati e quelli in balances: [(user_id, username, rigiocato, attuale)]."""
+    connection = connection or conn
+    actual = {uid: (uname, bal) for uid, uname, bal in connection.execute("SELECT user_id, username, balance FROM balances")}
+    rows = []
+    for uid in replay["balances"].keys() | actual.keys():
+        uname, replayed = replay["balances"].get(uid, (None, 0.0))
+        current = actual.get(uid, (uname, 0.0))[1] or 0.0
+        if abs(replayed - current) >= 0.01:
+            rows.append((uid, uname or actual[uid][0], replayed, current))
+    rows.sort(key=lambda r: -abs(r[2] - r[3]))
+    return rows
+
+
+def check_settlement(target_date):
+    """Controllo dopo /vincitore: rigioca target_date dall'ultimo snapshot precedente e confronta."""
+    row = conn.execute("SELECT MAX(date) FROM balance_snapshots WHERE date < ?", (target_date,)).fetchone()
+    if row[0] is None:
+        return None
+    replay = replay_settlements(since=row[0], until=target_date)
+    diff = replay_diff(replay)
+    if diff or replay["missing"]:
+        logging.warning(
+            f"Replay {row[0]} → {target_date}: {len(diff)} saldi diversi, chiusure mancanti {replay['missing']}",
+            extra={"fields": {"diff": diff[:10]}},
+        )
+    return diff
+
+
+# ---------------------- BACKUP ----------------------
+BACKUP_DIR = Path(os.getenv("BACKUP_DIR") or Path(DB_FILE).resolve().parent / "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_SLEEP = 0.005
+
+
+def backup_database(label=None):
+    """Snapshot online del DB con l'API di backup di SQLite, compresso gzip e ruotato.
+
+    La copia avanza a blocchi di BACKUP_PAGES_PER_STEP pagine con una breve pausa tra
+    un blocco e l'altro, così gli scrittori del bot non restano bloccati a lungo.
+    """
+    BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(ITALY_TZ).strftime("%Y%m%d-%H%M%S")
+    name = f"predictions-{stamp}" + (f"-{label}" if label else "")
+    raw_path = BACKUP_DIR / f"{name}.db.tmp"
+    final_path = BACKUP_DIR / f"{name}.db.gz"
+
+    source = sqlite3.connect(DB_FILE)
+    target = sqlite3.connect(raw_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+    finally:
+        target.close()
+        source.close()
+
+    gz_tmp = final_path.with_name(final_path.name + ".tmp")
+    with open(raw_path, "rb") as src, gzip.open(gz_tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    gz_tmp.replace(final_path)
+    raw_path.unlink()
+
+    snapshots = sorted(BACKUP_DIR.glob("predictions-*.db.gz"))
+    for old in snapshots[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        old.unlink()
+    logging.info(f"Backup DB completato: {final_path}")
+    return final_path
+
+
+async def backup_in_background(label=None):
+    try:
+        return await asyncio.to_thread(backup_database, label)
+    except Exception:
+        logging.exception("Errore durante il backup del DB")
+        return None
+
+
+def _balances_of(connection):
+    return connection.execute("SELECT user_id, balance FROM balances ORDER BY user_id").fetchall()
+
+
+def restore_database(snapshot_path, verify=True):
+    """Ripristina DB_FILE da uno snapshot .db.gz (a bot fermo).
+
+    Prima del ripristino salva uno snapshot "pre-restore" dello stato attuale; con
+    verify=True controlla che i saldi ripristinati coincidano con quelli dello snapshot.
+    Ritorna il numero di saldi ripristinati.
+    """
+    snapshot_path = Path(snapshot_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_path = Path(tmp_dir) / "snapshot.db"
+        with gzip.open(snapshot_path, "rb") as src, open(raw_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        # Dopo la decompressione: la rotazione del backup può eliminare proprio snapshot_path.
+        backup_database("pre-restore")
+        source = sqlite3.connect(raw_path)
+        target = sqlite3.connect(DB_FILE)
+        try:
+            expected = _balances_of(source)
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP)
+            restored = _balances_of(target)
+        finally:
+            target.close()
+            source.close()
+    if verify and restored != expected:
+        raise RuntimeError(f"Verifica ripristino fallita: i saldi di {DB_FILE} non coincidono con {snapshot_path}")
+    logging.info(f"DB ripristinato da {snapshot_path}: {len(restored)} saldi verificati")
+    return len(restored)
+
+
+# ---------------------- EXPORT ----------------------
+EXPORT_CHUNK_SIZE = 500
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_QUERIES = {
+    "predictions": """
+        SELECT date, user_id, username, prediction
+        FROM predictions WHERE date BETWEEN ? AND ?
+        ORDER BY date, user_id
+    """,
+    "settlements": """
+        SELECT e.date, e.user_id, e.username, e.prediction, r.closing_percentage,
+               e.diff, e.rank, e.fixed, e.variable, e.pot
+        FROM result_entries e JOIN results r ON r.date = e.date
+        WHERE e.date BETWEEN ? AND ?
+        ORDER BY e.date, e.rank IS NULL, e.rank, e.user_id
+    """,
+    "balances": """
+        SELECT date, user_id, username, balance
+        FROM balance_snapshots WHERE date BETWEEN ? AND ?
+        ORDER BY date, user_id
+    """,
+}
+EXPORT_FIELDS = [
+    "dataset", "date", "user_id", "username", "prediction", "closing_percentage",
+    "diff", "rank", "fixed", "variable", "pot", "balance",
+]
+
+
+def _open_readonly_db():
+    """Connessione di sola lettura separata: con WAL non blocca gli scrittori del bot."""
+    return sqlite3.connect(f"{Path(DB_FILE).resolve().as_uri()}?mode=ro", uri=True)
+
+
+def iter_export_rows(connection, date_from, date_to):
+    """Genera le righe dell'export un blocco alla volta, senza caricarle tutte in memoria."""
+    for dataset, query in EXPORT_QUERIES.items():
+        cursor = connection.execute(query, (date_from, date_to))
+        columns = [d[0] for d in cursor.description]
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            for row in chunk:
+                yield {"dataset": dataset, **dict(zip(columns, row))}
+
+
+def write_export(fileobj, date_from, date_to, fmt="csv"):
+    """Scrive l'export compresso gzip su fileobj (binario). Ritorna il numero di righe."""
+    count = 0
+    connection = _open_readonly_db()
+    try:
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as gz:
+            text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+            if fmt == "csv":
+                writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS)
+                writer.writeheader()
+                for row in iter_export_rows(connection, date_from, date_to):
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in iter_export_rows(connection, date_from, date_to):
+                    text.write(json.dumps(row, ensure_ascii=False) + "\n")
+                    count += 1
+            text.flush()
+            text.detach()
+    finally:
+        connection.close()
+    return count
+
+
+# ---------------------- LIVE ----------------------
+LIVE_POLL_SECONDS = int(os.getenv("LIVE_POLL_SECONDS", "60"))
+# Unica copia della quotazione intraday, aggiornata dal poller: /live legge solo da qui.
+_live_quote = {"pct": None, "timestamp": None, "fetched_at": None, "was_open": False}
+_live_ranking = {"key": None, "body": None}
+
+
+def us_market_open(now=None):
+    now = (now or datetime.now(ITALY_TZ)).astimezone(US_MARKET_TZ)
+    if now.weekday() in [5, 6] or now.strftime("%Y-%m-%d") in CHIUSURE_MERCATO:
+        return False
+    return US_MARKET_OPEN <= now.time() < US_MARKET_CLOSE
+
+
+async def live_quote_poller():
+    """Aggiorna la quotazione ogni LIVE_POLL_SECONDS a mercato aperto.
+
+    Fuori orario fa una sola richiesta all'avvio e una dopo la chiusura, per avere
+    l'ultimo prezzo della sessione.
+    """
+    while True:
+        try:
+            open_now = us_market_open()
+            if open_now or _live_quote["fetched_at"] is None or _live_quote["was_open"]:
+                quote = await asyncio.to_thread(get_gme_quote)
+                if quote:
+                    _live_quote["pct"], _live_quote["timestamp"] = quote
+                    _live_quote["fetched_at"] = datetime.now(ITALY_TZ)
+                _live_quote["was_open"] = open_now
+        except Exception as e:
+            logging.error(f"Errore nel poller della quotazione live: {e}")
+        await asyncio.sleep(LIVE_POLL_SECONDS)
+
+
+def _live_ranking_body(today, pct):
+    """Classifica provvisoria; ricalcolata solo quando cambia il prezzo (o la giornata o le regole)."""
+    plan = get_settlement_plan()
+    key = (today, pct, plan.version)
+    if _live_ranking["key"] == key:
+        return _live_ranking["body"]
+    players = sorted(
+        ((uid, uname, pred, round(abs(pred - pct), 2)) for uid, uname, pred in get_day_state(today).entries()),
+        key=lambda x: x[3],
+    )
+    if not players:
+        body = "🎲 Nessuna scommessa registrata per oggi."
+    else:
+        _, _, _, entries = compute_settlement(players, plan)
+        num_players = len(players)
+        body = "<b>📊 Classifica provvisoria:</b>\n"
+        for uid, uname, pred, diff in players:
+            rank, fisso, var = entries[uid][3], entries[uid][4], entries[uid][5]
+            label = "🏆" if rank <= len(plan.rewards) else "💀" if rank > num_players - len(plan.penalties) else "⚖️"
+            body += f"{label} <b>{rank}°</b> @{uname}: {pred:.2f}% (Diff: {diff:.2f}%) → {round(fisso + var, 2)}€\n"
+    _live_ranking["key"], _live_ranking["body"] = key, body
+    return body
+
+
+# ---------------------- STATO GIORNATA ----------------------
+class DayState:
+    """Scommesse, tesoretto e numero di scommettitori della giornata corrente.
+
+    Caricato una volta per giornata e aggiornato in write-through da add_bet: i comandi
+    in sola lettura su oggi non interrogano SQLite. Le previsioni sono salvate in
+    centesimi (interi Python, senza limite di grandezza anche per righe storiche) in ordine
+    di arrivo, con un indice ordinato per bisect.
+    pending contiene i giocatori (da balances, esclusi i bannati) che non hanno ancora
+    scommesso: si riduce a ogni add_bet e serve ai reminder senza query.
+    """
+
+    __slots__ = (
+        "date", "data_version", "pot", "user_ids", "cents", "usernames",
+        "sorted_cents", "sorted_names", "bettors", "pending",
+    )
+
+    def __init__(self, date):
+        self.date = date
+        self.data_version = None
+        self.user_ids = array("q")
+        self.cents = []
+        self.usernames = []
+        self.sorted_cents = []
+        self.sorted_names = []
+        self.bettors = set()
+        self.pending = {}
+        self.reload()
+
+    def reload(self):
+        del self.user_ids[:]
+        self.cents.clear()
+        self.sorted_cents.clear()
+        self.usernames.clear()
+        self.sorted_names.clear()
+        self.bettors.clear()
+        c.execute("SELECT user_id, username, prediction FROM predictions WHERE date = ? ORDER BY rowid", (self.date,))
+        for uid, uname, pred in c.fetchall():
+            self._append(uid, uname, _to_cents(pred))
+        self.refresh_pending()
+        self.refresh_pot()
+
+    def refresh_pending(self):
+        """Da richiamare dopo le scritture di questo worker su balances o bans."""
+        c.execute("""
+            SELECT user_id, username FROM balances
+            WHERE user_id NOT IN (SELECT user_id FROM bans WHERE ban_until >= ?)
+        """, (self.date,))
+        self.pending = {uid: uname for uid, uname in c.fetchall() if uid not in self.bettors}
+
+    def refresh_pot(self):
+        self.pot = get_unassigned_pot()
+
+    def _append(self, uid, uname, cents):
+        self.user_ids.append(uid)
+        self.cents.append(cents)
+        self.usernames.append(uname)
+        pos = bisect.bisect_right(self.sorted_cents, cents)
+        self.sorted_cents.insert(pos, cents)
+        self.sorted_names.insert(pos, uname)
+        self.bettors.add(uid)
+        self.pending.pop(uid, None)
+
+    @property
+    def count(self):
+        return len(self.user_ids)
+
+    def has_bet(self, user_id):
+        return user_id in self.bettors
+
+    def is_taken(self, prediction):
+        cents = _to_cents(prediction)
+        pos = bisect.bisect_left(self.sorted_cents, cents)
+        return pos < len(self.sorted_cents) and self.sorted_cents[pos] == cents
+
+    def nearest_free(self, prediction):
+        """Valori liberi più vicini sotto e sopra (passi di 0.01), cercati con bisect."""
+        taken = self.sorted_cents
+        cents = _to_cents(prediction)
+        pos = bisect.bisect_left(taken, cents)
+        if pos == len(taken) or taken[pos] != cents:
+            return [cents / 100]
+        up, i = cents, pos
+        while i < len(taken) and taken[i] == up:
+            up += 1
+            i += 1
+        down, i = cents, pos
+        while 0 <= i < len(taken) and taken[i] == down:
+            down -= 1
+            i -= 1
+        free = [down / 100] if down >= -10000 else []
+        return free + [up / 100]
+
+    def add_bet(self, user_id, username, prediction):
+        """Scrive la scommessa nel DB (commit) e poi nello stato in memoria.
+
+        Il controllo sul valore già preso è nello stesso INSERT, così vale anche tra
+        worker diversi. Ritorna False se un altro worker ha registrato prima la stessa
+        scommessa o lo stesso valore: lo stato viene ricaricato e il chiamante ricontrolla.
+        """
+        try:
+            c.execute("""
+                INSERT INTO predictions (user_id, username, prediction, date)
+                SELECT ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM predictions WHERE date = ? AND prediction = ?)
+            """, (user_id, username, prediction, self.date, self.date, prediction))
+            inserted = c.rowcount == 1
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            inserted = False
+        if not inserted:
+            self.reload()
+            return False
+        self._append(user_id, username, _to_cents(prediction))
+        return True
+
+    def entries(self):
+        return [(uid, uname, cents / 100) for uid, uname, cents in zip(self.user_ids, self.usernames, self.cents)]
+
+    def bets(self, reveal):
+        """Ordinate per valore se reveal, altrimenti solo nomi in ordine di arrivo."""
+        if not reveal:
+            return [(uname, None) for uname in self.usernames]
+        return [(uname, cents / 100) for uname, cents in zip(self.sorted_names, self.sorted_cents)]
+
+
+def _to_cents(prediction):
+    return int(round(prediction * 100))
+
+
+_day_state = None
+
+
+def get_day_state(date):
+    """Stato della giornata; ricaricato se un altro processo ha scritto nel DB.
+
+    PRAGMA data_version cambia solo per i commit di altre connessioni, quindi le
+    scommesse registrate da questo worker (già in memoria) non causano ricariche.
+    """
+    global _day_state
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if _day_state is None or _day_state.date != date:
+        _day_state = DayState(date)
+    elif version != _day_state.data_version:
+        _day_state.reload()
+        bump_data_version()
+    _day_state.data_version = version
+    return _day_state
+
+
+def refresh_pending_players():
+    """Aggiorna i giocatori in attesa dopo registrazioni o ban fatti da questo worker.
+
+    I commit propri non cambiano PRAGMA data_version, quindi get_day_state non se ne accorge.
+    """
+    if _day_state is not None:
+        _day_state.refresh_pending()
+
+
+# ---------------------- TABELLONE ----------------------
+SCOREBOARD_TICK_SECONDS = 5
+SCOREBOARD_DEBOUNCE_SECONDS = int(os.getenv("SCOREBOARD_DEBOUNCE_SECONDS", "10"))
+SCOREBOARD_MAX_DELAY_SECONDS = 60
+# Versione dei dati mostrati nel tabellone: aumenta a ogni scrittura su scommesse,
+# saldi o tesoretto. Il tabellone viene rigenerato solo quando cambia.
+_data_version = {"value": 0, "changed_at": 0.0}
+# chat_id -> message_id dei tabelloni attivi (copia in memoria della tabella scoreboards)
+_scoreboards = {}
+
+
+def bump_data_version():
+    _data_version["value"] += 1
+    _data_version["changed_at"] = asyncio.get_running_loop().time()
+
+
+def render_scoreboard(now):
+    today = now.strftime("%Y-%m-%d")
+    reveal = now.time() >= CUTOFF_TIME
+    day = get_day_state(today)
+    bets = day.bets(reveal)
+    msg = f"📌 <b>Tabellone GME</b> — {now.strftime('%d/%m/%Y')}\n\n"
+    msg += format_bets(bets, reveal) if bets else "🎲 Nessuna scommessa registrata per oggi.\n"
+    msg += f"\n💰 <b>Tesoretto attuale:</b> {day.pot:.2f}€\n\n"
+    rankings = fetch_rankings()
+    msg += format_rankings(rankings) if rankings else "📭 Nessun bilancio disponibile.\n"
+    msg += f"\n<i>Aggiornato alle {now.strftime('%H:%M')}</i>"
+    return msg
+
+
+async def scoreboard_updater(application: Application):
+    """Modifica i messaggi fissati solo quando i dati cambiano, con debounce."""
+    rendered_key = None
+    pending_since = None  # primo giro in cui i dati mostrati sono risultati vecchi
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SCOREBOARD_TICK_SECONDS)
+        try:
+            if not is_leader():
+                continue
+            # Riletta a ogni giro: /tabellone può essere gestito da un altro worker.
+            c.execute("SELECT chat_id, message_id FROM scoreboards")
+            _scoreboards.clear()
+            _scoreboards.update(c.fetchall())
+            if not _scoreboards:
+                continue
+            now = datetime.now(ITALY_TZ)
+            get_day_state(now.strftime("%Y-%m-%d"))
+            key = (_data_version["value"], now.strftime("%Y-%m-%d"), now.time() >= CUTOFF_TIME)
+            if key == rendered_key:
+                continue
+            if pending_since is None:
+                pending_since = loop.time()
+            quiet_for = loop.time() - _data_version["changed_at"]
+            if quiet_for < SCOREBOARD_DEBOUNCE_SECONDS and loop.time() - pending_since < SCOREBOARD_MAX_DELAY_SECONDS:
+                continue
+            text = render_scoreboard(now)
+            for chat_id, message_id in list(_scoreboards.items()):
+                try:
+                    await application.bot.edit_message_text(
+                        chat_id=chat_id, message_id=message_id, text=text, parse_mode=ParseMode.HTML
+                    )
+                except TelegramError as e:
+                    # Per chat: un errore (es. RetryAfter) non blocca gli altri tabelloni; la chat
+                    # resta indietro fino alla prossima modifica dei dati.
+                    if isinstance(e, BadRequest) and "not modified" in str(e).lower():
+                        continue
+                    if isinstance(e, Forbidden) or (isinstance(e, BadRequest) and "not found" in str(e).lower()):
+                        _scoreboards.pop(chat_id, None)
+                        c.execute("DELETE FROM scoreboards WHERE chat_id = ?", (chat_id,))
+                        conn.commit()
+                    logging.warning(f"Tabellone {chat_id} non aggiornato: {e}")
+            rendered_key = key
+            pending_since = None
+        except Exception as e:
+            logging.error(f"Errore aggiornamento tabellone: {e}")
+
+
+# ---------------------- PROFILER ----------------------
+# Profiler a campionamento attivato da /profile start: un thread legge ogni
+# PROFILE_INTERVAL_MS gli stack di tutti i thread e dei task asyncio. Da spento non
+# esiste: nessun thread, nessun hook sugli handler.
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "600"))
+PROFILE_TOP_N = 15
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _collapse(frames):
+    """Lista di frame dal più esterno al più interno → "a;b;c" (formato flamegraph)."""
+    return ";".join(_frame_label(f).replace(";", ",") for f in frames)
+
+
+class SamplingProfiler:
+    def __init__(self, loop, interval_ms=PROFILE_INTERVAL_MS):
+        self.loop = loop
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = datetime.now(ITALY_TZ)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        deadline = perf_counter() + PROFILE_MAX_SECONDS
+        while not self._stop.wait(self.interval):
+            if perf_counter() > deadline:
+                logging.warning("Profiler fermato: durata massima raggiunta")
+                return
+            self._sample()
+
+    def _sample(self):
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame)
+                frame = frame.f_back
+            self.stacks[f"thread:{names.get(thread_id, thread_id)};{_collapse(reversed(frames))}"] += 1
+        try:
+            tasks = list(asyncio.all_tasks(self.loop))
+        except RuntimeError:
+            # L'insieme dei task è cambiato durante la lettura: si salta questo campione.
+            tasks = []
+        for task in tasks:
+            frames = task.get_stack()
+            if frames:
+                self.stacks[f"task:{task.get_name()};{_collapse(frames)}"] += 1
+        self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, top=PROFILE_TOP_N):
+        """Funzioni più frequenti in cima allo stack del thread del loop (tempo "self")."""
+        prefix = f"thread:{threading.main_thread().name};"
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            if stack.startswith(prefix):
+                leaves[stack.rsplit(";", 1)[-1]] += count
+        return [(label, count, count * 100 / max(self.samples, 1)) for label, count in leaves.most_common(top)]
+
+
+_profiler = None
+
+
 # ---------------------- HANDLERS ----------------------
 async def bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.message.from_user.username
@@ -305,10 +2027,13 @@ async def bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not math.isfinite(raw_prediction):
             raise ValueError
 
-        # blocca valori impossibili (< -100%)
+        # blocca valori impossibili (< -100%) o assurdi
         if raw_prediction < -100:
             await update.message.reply_text("❌ Scommessa rifiutata: il minimo consentito è -100.00%.")
             return
+        if raw_prediction > MAX_PREDICTION:
+            await update.message.reply_text(f"❌ Scommessa rifiutata: il massimo consentito è {MAX_PREDICTION:.2f}%.")
+            return
 
         prediction = round(raw_prediction, 2)
 
@@ -316,8 +2041,18 @@ async def bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❗ Usa: /bet 2.5")
         return
 
-    c.execute("SELECT 1 FROM predictions WHERE user_id = ? AND date = ?", (user_id, today_date))
-    if c.fetchone():
+    day = get_day_state(today_date)
+    for _ in range(3):
+        if day.has_bet(user_id):
+            rejection = "⚠️ Hai già scommesso oggi! Non puoi cambiarla."
+        elif day.is_taken(prediction):
+            suggestions = " o ".join(f"{v:.2f}" for v in day.nearest_free(prediction))
+            rejection = f"⚠️ Valore già preso da un altro utente. Valori liberi più vicini: {suggestions}."
+        elif day.add_bet(user_id, username, prediction):
+            break
+        else:
+            # Un altro worker è arrivato prima: lo stato è stato ricaricato, si ricontrolla.
+            continue
         try:
             await update.message.delete()
         except Exception as e:
@@ -325,28 +2060,13 @@ async def bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             message_thread_id=getattr(update.message, "message_thread_id", None),
-            text="⚠️ Hai già scommesso oggi! Non puoi cambiarla."
+            text=rejection
         )
         return
-
-    c.execute("SELECT 1 FROM predictions WHERE prediction = ? AND date = ?", (prediction, today_date))
-    if c.fetchone():
-        try:
-            await update.message.delete()
-        except Exception as e:
-            logging.error(f"Errore delete: {e}")
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            message_thread_id=getattr(update.message, "message_thread_id", None),
-            text="⚠️ Valore già preso da un altro utente. Scegline uno diverso."
-        )
+    else:
+        await update.message.reply_text("❌ Errore nel salvataggio della scommessa, riprova.")
         return
-
-    c.execute(
-        "INSERT INTO predictions (user_id, username, prediction, date) VALUES (?, ?, ?, ?)",
-        (user_id, username, prediction, today_date)
-    )
-    conn.commit()
+    bump_data_version()
 
     try:
         await update.message.delete()
@@ -388,27 +2108,35 @@ async def bilancio(update: Update, context: ContextTypes.DEFAULT_TYPE):
             (update.message.from_user.id, username, 0.0)
         )
         conn.commit()
+        bump_data_version()
+        refresh_pending_players()
         balance = 0.0
     else:
         balance = round(row[0], 2)
     await update.message.reply_text(f"💰 Il tuo saldo attuale è: {balance}€")
 
+def fetch_rankings():
+    c.execute("""
+        SELECT b.user_id, MAX(b.username) as username, ROUND(SUM(b.balance), 2) as total_balance
+        FROM balances b
+        GROUP BY b.user_id
+        ORDER BY total_balance DESC
+    """)
+    return c.fetchall()
+
+def format_rankings(rankings):
+    msg = "<b>🏆 Classifica completa:</b>\n\n"
+    for i, (_, uname, bal) in enumerate(rankings, start=1):
+        msg += f"<b>{i}.</b> @{uname}: <b>{bal}€</b>\n"
+    return msg
+
 async def classifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        c.execute("""
-            SELECT b.user_id, MAX(b.username) as username, ROUND(SUM(b.balance), 2) as total_balance
-            FROM balances b
-            GROUP BY b.user_id
-            ORDER BY total_balance DESC
-        """)
-        rankings = c.fetchall()
+        rankings = fetch_rankings()
         if not rankings:
             await update.message.reply_text("📭 Nessun bilancio disponibile.")
             return
-        msg = "<b>🏆 Classifica completa:</b>\n\n"
-        for i, (_, uname, bal) in enumerate(rankings, start=1):
-            msg += f"<b>{i}.</b> @{uname}: <b>{bal}€</b>\n"
-        await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+        await update.message.reply_text(format_rankings(rankings), parse_mode=ParseMode.HTML)
     except Exception as e:
         logging.error(f"Errore classifica: {e}")
         await update.message.reply_text("❌ Errore nel recupero della classifica.")
@@ -416,30 +2144,74 @@ async def classifica(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def chatid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Il chat_id di questa chat è: {update.effective_chat.id}")
 
+def format_bets(bets, reveal):
+    """Elenco scommesse (già nell'ordine di DayState.bets): solo username prima del cutoff, anche i valori dopo."""
+    msg = "🎲 <b>Scommesse di oggi:</b>\n\n"
+    if reveal:
+        for uname, pred in bets:
+            msg += f"@{uname}: {pred:.2f}%\n"
+    else:
+        for uname, _ in bets:
+            msg += f"@{uname}\n"
+    return msg
+
 async def scommesse(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now(ITALY_TZ)
     today = now.strftime("%Y-%m-%d")
     current_time = now.time()
-    c.execute("SELECT username, prediction FROM predictions WHERE date = ?", (today,))
-    bets = c.fetchall()
+    reveal = current_time >= CUTOFF_TIME
+    bets = get_day_state(today).bets(reveal)
     if not bets:
         await update.message.reply_text("🎲 Nessuna scommessa registrata per oggi.")
         return
-    msg = "🎲 <b>Scommesse di oggi:</b>\n\n"
-    if current_time >= CUTOFF_TIME:
-        bets = sorted(bets, key=lambda x: x[1])
-        for uname, pred in bets:
-            msg += f"@{uname}: {pred:.2f}%\n"
-    else:
-        for uname, _ in bets:
-            msg += f"@{uname}\n"
+    await update.message.reply_text(format_bets(bets, reveal), parse_mode=ParseMode.HTML)
+
+async def live(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now(ITALY_TZ)
+    today = now.strftime("%Y-%m-%d")
+    if now.weekday() in [5, 6] or today in CHIUSURE_MERCATO:
+        await update.message.reply_text(f"❌ Il mercato è chiuso oggi ({today}).")
+        return
+    if now.time() < CUTOFF_TIME:
+        cutoff_str = f"{CUTOFF_TIME.hour:02d}:{CUTOFF_TIME.minute:02d}"
+        await update.message.reply_text(f"⏳ La classifica live è disponibile dopo le {cutoff_str}.")
+        return
+
+    pct, ts = _live_quote["pct"], _live_quote["timestamp"]
+    if pct is None or not ts or datetime.fromtimestamp(ts, US_MARKET_TZ).strftime("%Y-%m-%d") != today:
+        await update.message.reply_text("⚠️ Quotazione di oggi non ancora disponibile, riprova tra poco.")
+        return
+
+    quote_time = datetime.fromtimestamp(ts, ITALY_TZ).strftime("%H:%M")
+    status = "in corso" if us_market_open(now) else "chiusura"
+    msg = f"<b>📡 GME live ({status}, {quote_time}): {pct:+.2f}%</b>\n\n"
+    msg += _live_ranking_body(today, pct)
     await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
+POT_KIND_LABELS = {
+    "contribution": "➕ penalità",
+    "rollover": "↪️ riporto",
+    "award": "🏆 assegnato",
+    "adjustment": "✏️ rettifica",
+}
+
 async def tesoretto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    today = datetime.now(ITALY_TZ).date()
-    week_start = (today - timedelta(days=today.weekday())).strftime("%Y-%m-%d")
-    total = get_unassigned_pot(week_start)
-    await update.message.reply_text(f"💰 <b>Tesoretto attuale:</b> {total:.2f}€", parse_mode=ParseMode.HTML)
+    total = get_day_state(datetime.now(ITALY_TZ).strftime("%Y-%m-%d")).pot
+    msg = f"💰 <b>Tesoretto attuale:</b> {total:.2f}€"
+    if context.args and context.args[0].lower() == "storico":
+        history = get_pot_history()
+        if not history:
+            msg += "\n\n📭 Nessun movimento registrato."
+        else:
+            msg += "\n\n📒 <b>Ultimi movimenti</b>\n"
+            for week_start, date, kind, amount, uname, note in history:
+                line = f"{date or week_start} {POT_KIND_LABELS[kind]}: {amount:+.2f}€"
+                if kind == "award":
+                    line = f"{date} {POT_KIND_LABELS[kind]} a @{uname}: {-amount:.2f}€"
+                elif kind == "rollover":
+                    line = f"{date} {POT_KIND_LABELS[kind]} di {amount:.2f}€ ({note})"
+                msg += line + "\n"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
 async def vincitore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now(ITALY_TZ)
@@ -455,10 +2227,13 @@ async def vincitore(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Il mercato era chiuso il {target_date}.")
         return
 
-    c.execute("SELECT result FROM winners WHERE date = ?", (target_date,))
-    row = c.fetchone()
-    if row:
-        await update.message.reply_text(row[0], parse_mode=ParseMode.HTML)
+    msg = render_result(target_date)
+    if msg is None:
+        c.execute("SELECT result FROM winners WHERE date = ?", (target_date,))
+        row = c.fetchone()
+        msg = row[0] if row else None
+    if msg:
+        await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
         return
 
     c.execute("SELECT user_id, username, prediction FROM predictions WHERE date = ?", (target_date,))
@@ -472,187 +2247,267 @@ async def vincitore(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Dato GME non disponibile, riprova più tardi.")
         return
 
-    players = [(uid, uname, pred, round(abs(pred - closing_percentage), 2)) for uid, uname, pred in predictions]
-    players.sort(key=lambda x: x[3])
-    num_players = len(players)
+    try:
+        settle_day(target_date, closing_percentage, predictions)
+        conn.commit()
+        if _day_state is not None:
+            _day_state.refresh_pot()
+        bump_data_version()
+    except Exception:
+        conn.rollback()
+        logging.exception(f"Errore durante il calcolo vincitore per {target_date}")
+        await update.message.reply_text("⚠️ Errore durante il calcolo del vincitore. Riprova più tardi.")
+        return
+    asyncio.create_task(backup_in_background(target_date))
+    try:
+        check_settlement(target_date)
+    except Exception:
+        logging.exception(f"Errore nel controllo replay per {target_date}")
+    await update.message.reply_text(render_result(target_date), parse_mode=ParseMode.HTML)
 
-    c.execute("SELECT user_id, username FROM balances")
-    all_users = dict(c.fetchall())
-    bettors_today = {p[0] for p in players}
-    non_bettors = {uid: uname for uid, uname in all_users.items() if uid not in bettors_today}
+async def storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        dates = [datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d") for arg in context.args[:2]]
+        if not dates:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❗ Usa: /storico 2026-06-30 oppure /storico 2026-06-01 2026-06-30")
+        return
 
-    week_start = (date_obj - timedelta(days=date_obj.weekday())).strftime("%Y-%m-%d")
+    if len(dates) == 1:
+        msg = render_result(dates[0])
+        if msg is None:
+            c.execute("SELECT result FROM winners WHERE date = ?", (dates[0],))
+            row = c.fetchone()
+            msg = row[0] if row else f"📭 Nessun risultato salvato per il {dates[0]}."
+        await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+        return
 
+    c.execute("""
+        SELECT r.date, r.closing_percentage, e.username, e.prediction, e.diff
+        FROM results r
+        JOIN result_entries e ON e.date = r.date AND e.rank = 1
+        WHERE r.date BETWEEN ? AND ?
+        ORDER BY r.date
+        LIMIT ?
+    """, (dates[0], dates[1], STORICO_MAX_DAYS))
+    rows = c.fetchall()
+    if not rows:
+        await update.message.reply_text(f"📭 Nessun risultato tra il {dates[0]} e il {dates[1]}.")
+        return
+    msg = f"<b>📚 Storico {dates[0]} → {dates[1]}</b>\n\n"
+    for date, closing, uname, pred, diff in rows:
+        msg += f"<b>{date}</b>: GME {closing:+.2f}% — 🎯 @{uname} ({pred:.2f}%, Diff {diff:.2f}%)\n"
+    if len(rows) == STORICO_MAX_DAYS:
+        msg += f"\n<i>Mostrate solo le prime {STORICO_MAX_DAYS} giornate.</i>"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        target = context.args[0].lstrip("@")
+        c.execute("SELECT * FROM user_stats WHERE username = ?", (target,))
+    else:
+        target = update.message.from_user.username or str(update.message.from_user.id)
+        c.execute("SELECT * FROM user_stats WHERE user_id = ?", (update.message.from_user.id,))
+    row = c.fetchone()
+    if row is None or not row[2]:
+        await update.message.reply_text(f"📭 Nessuna statistica disponibile per @{target}.")
+        return
+    _, uname, bets, abs_error_sum, best_error, wins, streak, _, high, low = row
+    msg = (
+        f"📊 <b>Statistiche di @{uname}</b>\n\n"
+        f"• Scommesse valutate: {bets}\n"
+        f"• Errore medio: {abs_error_sum / bets:.2f}%\n"
+        f"• Miglior errore: {best_error:.2f}%\n"
+        f"• Vittorie: {wins} ({wins / bets * 100:.1f}%)\n"
+        f"• Serie attuale nella metà alta: {streak}\n"
+    )
+    if high is not None:
+        msg += f"• Saldo massimo/minimo: {high:.2f}€ / {low:.2f}€\n"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+
+async def ricalcola_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Solo l'admin può ricalcolare le statistiche.")
+        return
     try:
-        penalty_total = 10 * len(non_bettors)
-        for uid in non_bettors:
-            c.execute("UPDATE balances SET balance = ROUND(balance - 10, 2) WHERE user_id = ?", (uid,))
-        c.execute("""
-            INSERT INTO weekly_pot (week_start, amount)
-            VALUES (?, ?)
-            ON CONFLICT(week_start) DO UPDATE SET amount = ROUND(amount + ?, 2)
-        """, (week_start, penalty_total, penalty_total))
-
-        tesoretto_val = get_unassigned_pot(week_start)
-
-        perfect = next((p for p in players if p[3] == 0.0), None)
-        if perfect:
-            middle = num_players // 2
-            variable_pool = 0.0
-            losers_info = []
-            for i in range(middle):
-                diff_top = players[i][3]
-                diff_bottom = players[-(i + 1)][3]
-                loss = abs(round((diff_bottom - diff_top) * 5, 2))
-                variable_pool += loss
-                losers_info.append((players[-(i + 1)][0], players[-(i + 1)][1], loss))
-
-            fixed_penalties = [(-1, -150), (-2, -100), (-3, -50)]
-            fixed_losses = []
-            for idx, pen in fixed_penalties[:num_players]:
-                uid, uname, *_ = players[idx]
-                fixed_losses.append((uid, uname, pen))
-
-            pg_id, pg_uname, _, _ = perfect
-            total_prize = round(300 + variable_pool, 2)
-            bonus_tesoretto = 0.0
-
-            if date_obj.weekday() == 4 and target_date not in CHIUSURE_MERCATO and tesoretto_val > 0:
-                bonus_tesoretto = tesoretto_val
-                total_prize = round(total_prize + tesoretto_val, 2)
-                clear_unassigned_pot(week_start)
+        users, days = rebuild_user_stats()
+    except Exception:
+        conn.rollback()
+        logging.exception("Errore ricalcolo statistiche")
+        await update.message.reply_text("❌ Errore nel ricalcolo delle statistiche.")
+        return
+    await update.message.reply_text(f"✅ Statistiche ricalcolate: {users} utenti su {days} giornate.")
 
-            c.execute("""
-                INSERT INTO balances (user_id, username, balance)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    balance = ROUND(balance + ?, 2),
-                    username = excluded.username
-            """, (pg_id, pg_uname, total_prize, total_prize))
-
-            for loser_id, loser_uname, loss in losers_info:
-                c.execute("""
-                    INSERT INTO balances (user_id, username, balance)
-                    VALUES (?, ?, ?)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        balance = ROUND(balance - ?, 2),
-                        username = excluded.username
-                """, (loser_id, loser_uname, -loss, loss))
-
-            for uid, uname, fixed_penalty in fixed_losses:
-                c.execute("""
-                    INSERT INTO balances (user_id, username, balance)
-                    VALUES (?, ?, ?)
-                    ON CONFLICT(user_id) DO UPDATE SET
-                        balance = ROUND(balance + ?, 2),
-                        username = excluded.username
-                """, (uid, uname, fixed_penalty, fixed_penalty))
-
-            msg = f"<b>📈 Variazione GME ({target_date}): {closing_percentage}%</b>\n"
-            msg += f"<i>Tesoretto attuale: {tesoretto_val}€</i>\n\n"
-            msg += f"🎯 <b>Perfect guess!</b> @{pg_uname} ha indovinato esattamente.\n"
-            msg += f"🏅 Guadagna: 300€ + {round(variable_pool, 2)}€"
-            if bonus_tesoretto > 0:
-                msg += f" + {bonus_tesoretto}€ (tesoretto)"
-            msg += f" = <b>{round(total_prize, 2)}€</b>\n\n"
-
-            msg += "<b>📊 Partecipanti:</b>\n"
-            for uid, uname, pred, diff in players:
-                label = "🏆" if uid == pg_id else "•"
-                msg += f"{label} @{uname}: {pred:.2f}% (Diff: {diff:.2f}%)\n"
-
-            msg += "\n<b>❌ Perdenti (variabile):</b>\n"
-            for _, uname, loss in losers_info:
-                msg += f"• @{uname}: -{loss}€\n"
-
-            msg += "\n<b>💀 Penalità fisse:</b>\n"
-            for _, uname, fixed in fixed_losses:
-                msg += f"• @{uname}: {fixed}€\n"
-
-            if non_bettors:
-                msg += "\n<b>😴 Non hanno scommesso e perdono 10€:</b>\n"
-                for uname in non_bettors.values():
-                    msg += f"• @{uname}\n"
-
-            c.execute("INSERT INTO winners (date, result) VALUES (?, ?)", (target_date, msg))
-            conn.commit()
-            await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Solo l'admin può esportare i dati.")
+        return
+    try:
+        date_from, date_to = (datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d") for arg in context.args[:2])
+        fmt = context.args[2].lower() if len(context.args) > 2 else "csv"
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("❗ Usa: /export 2026-01-01 2026-06-30 [csv|jsonl]")
+        return
+
+    with tempfile.TemporaryFile() as tmp:
+        try:
+            count = await asyncio.to_thread(write_export, tmp, date_from, date_to, fmt)
+        except Exception:
+            logging.exception(f"Errore export {date_from} → {date_to}")
+            await update.message.reply_text("❌ Errore durante l'export.")
             return
+        tmp.seek(0)
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=tmp,
+            filename=f"gme_export_{date_from}_{date_to}.{fmt}.gz",
+            caption=f"📦 Export {date_from} → {date_to}: {count} righe",
+            message_thread_id=getattr(update.message, "message_thread_id", None),
+        )
 
-        rewards = {1: 150, 2: 100, 3: 50}
-        penalties = {-1: -150, -2: -100, -3: -50}
-        risk_multiplier = 5
-
-        changes = {uid: [uname, 0.0, 0.0] for uid, uname, _, _ in players}
-        for i in range(min(3, num_players)):
-            changes[players[i][0]][1] += rewards[i + 1]
-            changes[players[-(i + 1)][0]][1] += penalties[-(i + 1)]
-
-        for i in range(num_players // 2):
-            top = players[i]
-            bottom = players[-(i + 1)]
-            delta = round((bottom[3] - top[3]) * risk_multiplier, 2)
-            changes[top[0]][2] += delta
-            changes[bottom[0]][2] -= delta
-
-        if num_players % 2 == 1:
-            mid_uid = players[num_players // 2][0]
-            changes[mid_uid][1] = 0.0
-            changes[mid_uid][2] = 0.0
-
-        for uid, (uname, fisso, var) in changes.items():
-            totale = round(fisso + var, 2)
-            c.execute("""
-                INSERT INTO balances (user_id, username, balance)
-                VALUES (?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET
-                    balance = ROUND(balance + ?, 2),
-                    username = excluded.username
-            """, (uid, uname, totale, totale))
+async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Solo l'admin può avviare un backup.")
+        return
+    path = await backup_in_background("manuale")
+    if path is None:
+        await update.message.reply_text("❌ Errore durante il backup.")
+        return
+    await update.message.reply_text(f"✅ Backup salvato: {path.name}")
 
-        tesoretto_val = get_unassigned_pot(week_start)
+async def tabellone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Solo l'admin può gestire il tabellone.")
+        return
+    chat_id = update.effective_chat.id
+    if context.args and context.args[0].lower() == "off":
+        message_id = _scoreboards.pop(chat_id, None)
+        c.execute("DELETE FROM scoreboards WHERE chat_id = ?", (chat_id,))
+        conn.commit()
+        if message_id:
+            try:
+                await context.bot.unpin_chat_message(chat_id=chat_id, message_id=message_id)
+            except Exception as e:
+                logging.error(f"Errore unpin tabellone: {e}")
+        await update.message.reply_text("✅ Tabellone disattivato.")
+        return
 
-        msg = f"<b>📈 Variazione GME ({target_date}): {closing_percentage}%</b>\n"
-        msg += f"<i>Tesoretto attuale: {tesoretto_val}€</i>\n\n"
+    message = await context.bot.send_message(
+        chat_id=chat_id,
+        text=render_scoreboard(datetime.now(ITALY_TZ)),
+        parse_mode=ParseMode.HTML,
+        message_thread_id=getattr(update.message, "message_thread_id", None),
+    )
+    try:
+        await context.bot.pin_chat_message(chat_id=chat_id, message_id=message.message_id, disable_notification=True)
+    except Exception as e:
+        logging.error(f"Errore pin tabellone: {e}")
+    c.execute(
+        "INSERT OR REPLACE INTO scoreboards (chat_id, message_id, thread_id) VALUES (?, ?, ?)",
+        (chat_id, message.message_id, getattr(update.message, "message_thread_id", None)),
+    )
+    conn.commit()
+    _scoreboards[chat_id] = message.message_id
 
-        sorted_results = sorted(changes.items(), key=lambda item: -(item[1][1] + item[1][2]))
-        winner_uid, (winner_username, winner_fisso, winner_var) = sorted_results[0]
-        winner_tot = round(winner_fisso + winner_var, 2)
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _profiler
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Solo l'admin può usare il profiler.")
+        return
+    action = context.args[0].lower() if context.args else ""
+    if action == "start":
+        if _profiler is not None:
+            await update.message.reply_text("ℹ️ Il profiler è già attivo. Usa /profile stop.")
+            return
+        try:
+            interval_ms = int(context.args[1]) if len(context.args) > 1 else PROFILE_INTERVAL_MS
+            if interval_ms < 1:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text("❗ Usa: /profile start [intervallo_ms]")
+            return
+        _profiler = SamplingProfiler(asyncio.get_running_loop(), interval_ms)
+        _profiler.start()
+        await update.message.reply_text(
+            f"🔬 Profiler avviato: un campione ogni {interval_ms} ms (max {PROFILE_MAX_SECONDS}s). Usa /profile stop."
+        )
+        return
+    if action != "stop":
+        await update.message.reply_text("❗ Usa: /profile start [intervallo_ms] oppure /profile stop")
+        return
+    if _profiler is None:
+        await update.message.reply_text("ℹ️ Il profiler non è attivo.")
+        return
 
-        for i, (uid, (uname, fisso, var)) in enumerate(sorted_results):
-            pred = next(p for u, n, p, _ in players if u == uid)
-            diff = round(abs(pred - closing_percentage), 2)
-            total = round(fisso + var, 2)
-            rank = i + 1
-            label = "🏆" if rank <= 3 else "💀" if rank > num_players - 3 else "⚖️"
-            msg += (
-                f"{label} <b>{rank}°</b>: @{uname} → {pred:.2f}% "
-                f"(Diff: {diff:.2f}%) | Fisso: {fisso}€, Variabile: {var}€, Totale: {total}€\n"
-            )
+    profiler, _profiler = _profiler, None
+    await asyncio.to_thread(profiler.stop)
+    seconds = (datetime.now(ITALY_TZ) - profiler.started_at).total_seconds()
+    msg = f"🔬 <b>Profilo</b>: {profiler.samples} campioni in {seconds:.0f}s\n<pre>"
+    for label, count, pct in profiler.summary():
+        msg += f"{pct:5.1f}% {count:6d}  {html.escape(label)}\n"
+    msg += "</pre>"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=profiler.collapsed().encode("utf-8"),
+        filename=f"profile-{profiler.started_at:%Y%m%d-%H%M%S}.collapsed.txt",
+        caption="Stack compressi (flamegraph.pl / speedscope)",
+        message_thread_id=getattr(update.message, "message_thread_id", None),
+    )
 
-        if non_bettors:
-            msg += "\n<b>😴 Non hanno scommesso e perdono 10€:</b>\n"
-            for uname in non_bettors.values():
-                msg += f"• @{uname}\n"
-
-        if date_obj.weekday() == 4 and target_date not in CHIUSURE_MERCATO and tesoretto_val > 0:
-            c.execute("UPDATE balances SET balance = ROUND(balance + ?, 2) WHERE user_id = ?", (tesoretto_val, winner_uid))
-            clear_unassigned_pot(week_start)
-            total_final = round(winner_tot + tesoretto_val, 2)
-            msg += (
-                f"\n💰 Tesoretto settimanale: @{winner_username} riceve anche <b>{tesoretto_val}€</b> extra!\n"
-                f"🤑 Guadagno complessivo del giorno: <b>{total_final}€</b>\n"
-            )
+async def regole(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args and context.args[0].lower() == "set":
+        if update.effective_user.id != ADMIN_CHAT_ID:
+            await update.message.reply_text("⛔ Solo l'admin può cambiare le regole.")
+            return
+        try:
+            plan = add_scoring_rules(json.loads(" ".join(context.args[1:])))
+        except (ValueError, TypeError, AttributeError) as e:
+            await update.message.reply_text(f"❗ Regole non valide: {e}\nUsa: /regole set {{\"risk_multiplier\": 6}}")
+            return
+        await update.message.reply_text(f"✅ Regole aggiornate alla versione {plan.version}.")
+        return
+    plan = get_settlement_plan()
+    msg = (
+        f"📐 <b>Regole di punteggio (versione {plan.version})</b>\n\n"
+        f"• Premi fissi: {', '.join(f'{v}€' for v in plan.rewards)}\n"
+        f"• Penalità fisse (dall'ultimo): {', '.join(f'{v}€' for v in plan.penalties)}\n"
+        f"• Moltiplicatore variabile: {plan.risk_multiplier}€ per punto di differenza\n"
+        f"• Perfect guess: {plan.perfect_guess_prize}€\n"
+        f"• Penalità per chi non scommette: {plan.non_bettor_penalty}€\n"
+    )
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
-        c.execute("INSERT INTO winners (date, result) VALUES (?, ?)", (target_date, msg))
-        conn.commit()
-        await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
-    except Exception:
-        conn.rollback()
-        logging.exception(f"Errore durante il calcolo vincitore per {target_date}")
-        await update.message.reply_text("⚠️ Errore durante il calcolo del vincitore. Riprova più tardi.")
+async def whatif(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("⛔ Solo l'admin può simulare regole alternative.")
+        return
+    try:
+        date_from, date_to = (datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d") for arg in context.args[:2])
+        overrides = json.loads(" ".join(context.args[2:]) or "{}")
+        days, report = whatif_report(date_from, date_to, overrides)
+    except (ValueError, TypeError, AttributeError) as e:
+        await update.message.reply_text(f"❗ {e}\nUsa: /whatif 2026-01-01 2026-06-30 {{\"risk_multiplier\": 6}}")
+        return
+    if not report:
+        await update.message.reply_text(f"📭 Nessun risultato salvato tra il {date_from} e il {date_to}.")
+        return
+    msg = f"🧪 <b>What-if {date_from} → {date_to}</b> ({days} giornate, tesoretto escluso)\n\n"
+    for uname, actual, alt in report:
+        msg += f"@{uname}: {actual:+.2f}€ → {alt:+.2f}€ ({alt - actual:+.2f}€)\n"
+    await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
 
 async def istruzioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    plan = get_settlement_plan()
+
+    def euro(value):
+        return f"{value:g}".replace(".", ",")
+
+    rewards = "".join(f"• {i}° classificato: +{euro(v)}€\n" for i, v in enumerate(plan.rewards, start=1))
+    penalties = ", ".join(f"{euro(v)}€" for v in reversed(plan.penalties))
     msg = (
         "🎯 <b>OBIETTIVO</b>\n"
         "Ogni giorno si scommette sulla variazione percentuale del titolo GME "
@@ -695,39 +2550,37 @@ async def istruzioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "3) Ordina i giocatori in base alla distanza assoluta dal valore reale (Diff).\n\n"
 
         "<b>Premi Fissi:</b>\n"
-        "• 1° classificato: +150€\n"
-        "• 2° classificato: +100€\n"
-        "• 3° classificato: +50€\n"
-        "• Ultimi 3: -50€, -100€, -150€ (dal terzultimo all’ultimo)\n\n"
+        f"{rewards}"
+        f"• Ultimi {len(plan.penalties)}: {penalties} (fino all’ultimo)\n\n"
 
         "<b>Variabile:</b>\n"
         "• Parte variabile: il bot confronta quanto ogni previsione è lontana dal valore reale.\n"
         "• Ogni giocatore nella prima metà della classifica giornaliera guadagna quello che perde "
         "il corrispettivo giocatore nella seconda metà.\n"
-        "• La formula utilizzata è: differenza_di_errore_in_punti_percentuali × 5€.\n"
-        "In pratica, ogni 0,1 punti percentuali di errore in più tra due giocatori valgono 0,5€ "
-        "a favore del più preciso (e -0,5€ per l’altro).\n\n"
+        f"• La formula utilizzata è: differenza_di_errore_in_punti_percentuali × {euro(plan.risk_multiplier)}€.\n"
+        f"In pratica, ogni 0,1 punti percentuali di errore in più tra due giocatori valgono {euro(plan.risk_multiplier / 10)}€ "
+        f"a favore del più preciso (e -{euro(plan.risk_multiplier / 10)}€ per l’altro).\n\n"
 
         "Se hai scommesso:\n"
         "• Puoi vincere o perdere in base a posizione, fissi e variabili.\n\n"
         "Se NON hai scommesso:\n"
-        "• Perdi sempre 10€ di penalità giornaliera.\n"
-        "• I 10€ per ogni inattivo vanno a formare il “tesoretto” della settimana.\n\n"
+        f"• Perdi sempre {euro(plan.non_bettor_penalty)}€ di penalità giornaliera.\n"
+        f"• I {euro(plan.non_bettor_penalty)}€ per ogni inattivo vanno a formare il “tesoretto” della settimana.\n\n"
 
         "────────────────────\n"
         "🎯 <b>PERFECT GUESS</b>\n"
         "────────────────────\n"
         "Se almeno un giocatore indovina esattamente la variazione (es. GME fa +0.00% e qualcuno ha scommesso 0.00%), "
         "scatta la modalità “perfect guess”:\n\n"
-        "• Il perfect guesser si porta a casa tutto il bottino: prende un fisso di 300€.\n"
+        f"• Il perfect guesser si porta a casa tutto il bottino: prende un fisso di {euro(plan.perfect_guess_prize)}€.\n"
         "• Viene calcolata comunque la parte variabile contro i giocatori perdenti, cioè quelli della seconda metà "
         "della classifica giornaliera.\n\n"
 
         "────────────────────\n"
         "💰 <b>TESORETTO SETTIMANALE</b>\n"
         "────────────────────\n"
-        "• Ogni giorno, chi NON scommette perde 10€.\n"
-        "• Questi 10€ a testa vengono accumulati in un tesoretto settimanale.\n"
+        f"• Ogni giorno, chi NON scommette perde {euro(plan.non_bettor_penalty)}€.\n"
+        f"• Questi {euro(plan.non_bettor_penalty)}€ a testa vengono accumulati in un tesoretto settimanale.\n"
         "• Il comando /vincitore aggiorna il tesoretto e il saldo dei non scommettitori.\n\n"
         "Assegnazione tesoretto:\n"
         "• Il venerdì è il grande giorno! Chi arriva primo il venerdì si porta a casa il tesoretto della settimana!\n\n"
@@ -746,10 +2599,16 @@ async def istruzioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "  – non ricalcola se esiste già un record in winners per quella data.\n\n"
         "/scommesse\n"
         "  Mostra le scommesse registrate per la giornata in corso.\n\n"
+        "/live\n"
+        "  Dopo le 15:30 mostra la variazione attuale di GME e la classifica provvisoria.\n\n"
         "/classifica\n"
         "  Mostra la classifica completa con i saldi correnti.\n\n"
         "/bilancio\n"
         "  Mostra il tuo saldo personale.\n\n"
+        "/stats [@username]\n"
+        "  Mostra errore medio, vittorie, serie e saldo massimo/minimo.\n\n"
+        "/storico &lt;data&gt; [&lt;data_fine&gt;]\n"
+        "  Mostra il risultato di una giornata (YYYY-MM-DD) o il riepilogo di un intervallo.\n\n"
         "/istruzioni\n"
         "  Mostra questo manuale.\n\n"
         "/help\n"
@@ -759,7 +2618,23 @@ async def istruzioni(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/unban &lt;username&gt;          (solo admin)\n"
         "  Sblocca un utente bannato.\n\n"
         "/bannati                    (solo admin)\n"
-        "  Mostra la lista degli utenti attualmente bannati.\n"
+        "  Mostra la lista degli utenti attualmente bannati.\n\n"
+        "/ricalcola_stats            (solo admin)\n"
+        "  Ricalcola da zero le statistiche di tutti gli utenti.\n\n"
+        "/export &lt;da&gt; &lt;a&gt; [csv|jsonl]   (solo admin)\n"
+        "  Invia un file .gz con previsioni, risultati e saldi dell'intervallo.\n\n"
+        "/backup                     (solo admin)\n"
+        "  Salva subito uno snapshot compresso del database.\n\n"
+        "/regole\n"
+        "  Mostra le regole di punteggio in vigore.\n\n"
+        "/regole set &lt;json&gt;         (solo admin)\n"
+        "  Crea una nuova versione delle regole (es. {\"risk_multiplier\": 6}).\n\n"
+        "/whatif &lt;da&gt; &lt;a&gt; &lt;json&gt;    (solo admin)\n"
+        "  Ricalcola le giornate passate con regole alternative, senza toccare i saldi.\n\n"
+        "/profile start|stop         (solo admin)\n"
+        "  Campiona gli stack del bot e al termine invia un riepilogo e il file per il flamegraph.\n\n"
+        "/tabellone [off]            (solo admin)\n"
+        "  Fissa nella chat un messaggio con scommesse, tesoretto e classifica aggiornato da solo.\n"
 
     )
     await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
@@ -771,13 +2646,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "<b>Gioco</b>\n"
         "• /bet &lt;valore&gt; — registra la scommessa giornaliera.\n"
         "• /scommesse — mostra le scommesse del giorno.\n"
+        "• /live — variazione GME in tempo reale e classifica provvisoria.\n"
         "• /vincitore — calcola il vincitore del giorno dopo la chiusura.\n"
         "• /vincitore yesterday — calcola il vincitore del giorno precedente.\n"
         "• /classifica — mostra la classifica completa.\n"
         "• /bilancio — mostra il tuo saldo personale.\n"
-        "• /tesoretto — mostra il tesoretto disponibile.\n\n"
+        "• /stats [@username] — statistiche personali.\n"
+        "• /storico &lt;data&gt; [&lt;data_fine&gt;] — risultati passati.\n"
+        "• /tesoretto [storico] — mostra il tesoretto disponibile e i suoi ultimi movimenti.\n\n"
         "<b>Info</b>\n"
         "• /istruzioni — mostra il regolamento completo.\n"
+        "• /regole — mostra le regole di punteggio in vigore.\n"
         "• /help — mostra questo elenco comandi.\n"
         "• /id — registra/invia il tuo ID Telegram all'admin.\n"
         "• /chatid — mostra il chat_id della chat corrente.\n\n"
@@ -785,7 +2664,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• /ban &lt;username&gt; &lt;giorni&gt; — banna un utente.\n"
         "• /unban &lt;username&gt; — rimuove il ban.\n"
         "• /bannati — mostra gli utenti bannati.\n"
-        "• /admin — mostra gli amministratori della chat.\n\n"
+        "• /admin — mostra gli amministratori della chat.\n"
+        "• /ricalcola_stats — ricalcola le statistiche utenti.\n"
+        "• /export &lt;da&gt; &lt;a&gt; [csv|jsonl] — esporta lo storico.\n"
+        "• /backup — salva uno snapshot del database.\n"
+        "• /tabellone [off] — attiva/disattiva il tabellone fissato.\n"
+        "• /regole set &lt;json&gt; — nuova versione delle regole.\n"
+        "• /whatif &lt;da&gt; &lt;a&gt; &lt;json&gt; — simula regole alternative.\n"
+        "• /profile start|stop — profiler a campionamento.\n\n"
         "<b>Test</b>\n"
         "• /betTEST &lt;valore&gt; — comando di test per scommessa.\n"
         "• /testVincitore — simula il calcolo del vincitore.\n"
@@ -823,6 +2709,7 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ban_until = (datetime.now(ITALY_TZ).date() + timedelta(days=giorni)).strftime("%Y-%m-%d")
     c.execute("INSERT OR REPLACE INTO bans (user_id, ban_until) VALUES (?, ?)", (user_id, ban_until))
     conn.commit()
+    refresh_pending_players()
     await update.message.reply_text(f"✅ @{username} bannato fino al {ban_until}.")
 
 async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -841,6 +2728,7 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     c.execute("DELETE FROM bans WHERE user_id = ?", (res[0],))
     conn.commit()
+    refresh_pending_players()
     await update.message.reply_text(f"✅ Ban rimosso per @{username}.")
 
 async def bannati(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -868,7 +2756,7 @@ async def bannati(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         chat = update.effective_chat
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admins = await get_chat_admins(context.bot, chat.id)
         mentions = []
         for a in admins:
             u = a.user
@@ -883,39 +2771,23 @@ async def testVincitore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     closing_percentage = round(random.uniform(-10, 10), 2)
     players = [f"Player{i}" for i in range(1, 17)]
     predictions = [(p, round(random.uniform(-10, 10), 2)) for p in players]
-    predictions = [(u, pr, round(abs(pr - closing_percentage), 2)) for u, pr in predictions]
-    predictions.sort(key=lambda x: x[2])
+    predictions = [(u, u, pr, round(abs(pr - closing_percentage), 2)) for u, pr in predictions]
+    predictions.sort(key=lambda x: x[3])
     num_players = len(predictions)
-    rewards = {1: 150, 2: 100, 3: 50}
-    penalties = {-1: -150, -2: -100, -3: -50}
-    risk_multiplier = 5
-    balance_changes = {u: [0, 0] for u, _, _ in predictions}
-    for i in range(3):
-        balance_changes[predictions[i][0]][0] += rewards[i + 1]
-        balance_changes[predictions[-(i + 1)][0]][0] += penalties[-(i + 1)]
-    middle_index = num_players // 2
-    for i in range(middle_index):
-        _, _, diff_top = predictions[i]
-        _, _, diff_bottom = predictions[-(i + 1)]
-        variable_bonus = (diff_bottom - diff_top) * risk_multiplier
-        balance_changes[predictions[i][0]][1] += variable_bonus
-        balance_changes[predictions[-(i + 1)][0]][1] -= variable_bonus
-    if num_players % 2 == 1:
-        balance_changes[predictions[middle_index][0]] = [0, 0]
-    sorted_results = sorted(balance_changes.items(), key=lambda x: -(x[1][0] + x[1][1]))
+    plan = get_settlement_plan()
+    _, _, _, entries = compute_settlement(predictions, plan)
+    sorted_results = sorted(entries.items(), key=lambda x: -(x[1][4] + x[1][5]))
     message = f"\n📈 Simulazione Test - Variazione GME: {closing_percentage}%\n\n"
-    for i, (user, changes) in enumerate(sorted_results):
-        prediction = next(pr for u, pr, _ in predictions if u == user)
-        diff = round(abs(prediction - closing_percentage), 2)
+    for i, (user, (_, prediction, diff, _, fixed_part, variable_part, _)) in enumerate(sorted_results):
         rank = i + 1
-        fixed_part, variable_part = changes
         total = round(fixed_part + variable_part, 2)
-        if rank <= 3:
-            message += f"🏆 {rank}°: @{user} → {prediction}% (Diff {diff}%) Fisso {fixed_part}€, Var {variable_part:.2f}€, Tot {total}€\n"
-        elif rank > num_players - 3:
-            message += f"💀 {rank}°: @{user} → {prediction}% (Diff {diff}%) Fisso {fixed_part}€, Var {variable_part:.2f}€, Tot {total}€\n"
+        if rank <= len(plan.rewards):
+            label = "🏆"
+        elif rank > num_players - len(plan.penalties):
+            label = "💀"
         else:
-            message += f"⚖️ {rank}°: @{user} → {prediction}% (Diff {diff}%) Fisso {fixed_part}€, Var {variable_part:.2f}€, Tot {total}€\n"
+            label = "⚖️"
+        message += f"{label} {rank}°: @{user} → {prediction}% (Diff {diff}%) Fisso {fixed_part}€, Var {variable_part:.2f}€, Tot {total}€\n"
     await update.message.reply_text(message)
 
 async def testapi(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -941,6 +2813,276 @@ async def betTEST(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message_thread_id=getattr(update.message, "message_thread_id", None)
     )
 
+# ---------------------- COORDINAMENTO ----------------------
+# Più worker (webhook dietro un bilanciatore) condividono il database; lo stato che
+# serve a coordinarli sta in un backend separato: lease per il leader che esegue i
+# job singoli (reminder, keep-alive, tabellone) e "claim" una tantum per update_id e
+# reminder già inviati. SqliteCoordination usa un file accanto al DB (i worker sono
+# sulla stessa macchina/volume); MemoryCoordination è il sostituto per un solo
+# processo e per i test. Il file è separato perché le sue scritture non devono far
+# ricaricare DayState (che osserva PRAGMA data_version del DB principale).
+COORDINATION_BACKEND = os.getenv("COORDINATION_BACKEND", "sqlite")   # sqlite | memory
+COORDINATION_DB = os.getenv("COORDINATION_DB", str(Path(DB_FILE).with_suffix(".coord.db")))
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE_SECONDS = 30
+
+
+def _wall_clock():
+    return datetime.now(timezone.utc).timestamp()
+
+
+class MemoryCoordination:
+    def __init__(self):
+        self._leases = {}
+        self._claims = {}
+        self._updates = {}
+
+    def acquire_lease(self, name, owner, ttl):
+        now = _wall_clock()
+        holder = self._leases.get(name)
+        if holder is None or holder[0] == owner or holder[1] <= now:
+            self._leases[name] = (owner, now + ttl)
+            return True
+        return False
+
+    def release_lease(self, name, owner):
+        if self._leases.get(name, (None,))[0] == owner:
+            del self._leases[name]
+
+    def claim(self, key):
+        if key in self._claims:
+            return False
+        self._claims[key] = _wall_clock()
+        return True
+
+    def claim_update(self, update_id):
+        if update_id in self._updates:
+            return False
+        self._updates[update_id] = _wall_clock()
+        return True
+
+    def prune(self, before):
+        for store in (self._claims, self._updates):
+            for key in [k for k, ts in store.items() if ts < before]:
+                del store[key]
+
+
+class SqliteCoordination:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("PRAGMA busy_timeout=5000;")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS claims (
+                key TEXT PRIMARY KEY,
+                claimed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                update_id INTEGER PRIMARY KEY,
+                processed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates(processed_at)")
+
+    def acquire_lease(self, name, owner, ttl):
+        now = _wall_clock()
+        cur = self.conn.execute("""
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at <= ?
+        """, (name, owner, now + ttl, now))
+        return cur.rowcount == 1
+
+    def release_lease(self, name, owner):
+        self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def claim(self, key):
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO claims (key, claimed_at) VALUES (?, ?)", (key, _wall_clock())
+        )
+        return cur.rowcount == 1
+
+    def claim_update(self, update_id):
+        cur = self.conn.execute(
+            "INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)",
+            (update_id, _wall_clock()),
+        )
+        return cur.rowcount == 1
+
+    def prune(self, before):
+        self.conn.execute("DELETE FROM processed_updates WHERE processed_at < ?", (before,))
+        self.conn.execute("DELETE FROM claims WHERE claimed_at < ?", (before,))
+
+
+if COORDINATION_BACKEND == "memory":
+    coordination = MemoryCoordination()
+else:
+    coordination = SqliteCoordination(COORDINATION_DB)
+
+_leadership = {"leader": False}
+
+
+def is_leader():
+    return _leadership["leader"]
+
+
+async def leader_election():
+    """Rinnova il lease "leader" ogni terzo di durata; chi lo tiene esegue i job singoli."""
+    while True:
+        try:
+            leader = coordination.acquire_lease("leader", WORKER_ID, LEADER_LEASE_SECONDS)
+        except sqlite3.Error as e:
+            logging.error(f"Errore rinnovo lease leader: {e}")
+            leader = False
+        if leader != _leadership["leader"]:
+            logging.info(f"Worker {WORKER_ID}: {'leader' if leader else 'non più leader'}")
+        _leadership["leader"] = leader
+        await asyncio.sleep(LEADER_LEASE_SECONDS / 3)
+
+
+# Deduplica degli update: un LRU in memoria davanti alla tabella processed_updates.
+# Un doppione già visto da questo worker costa una ricerca nel dizionario; la tabella
+# copre i riavvii e gli altri worker, e viene potata oltre UPDATE_DEDUPE_TTL_HOURS
+# (Telegram non riconsegna update più vecchi di 24 ore).
+UPDATE_DEDUPE_SIZE = 4096
+UPDATE_DEDUPE_TTL_HOURS = 48
+_recent_updates = OrderedDict()
+
+
+async def claim_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Gruppo -2: un update già gestito (da qui o da un altro worker) si ferma prima degli handler."""
+    update_id = update.update_id
+    if update_id in _recent_updates:
+        _recent_updates.move_to_end(update_id)
+        logging.info(f"Update {update_id} duplicato: ignorato")
+        raise ApplicationHandlerStop
+    _recent_updates[update_id] = None
+    if len(_recent_updates) > UPDATE_DEDUPE_SIZE:
+        _recent_updates.popitem(last=False)
+    if not coordination.claim_update(update_id):
+        logging.info(f"Update {update_id} già gestito: ignorato")
+        raise ApplicationHandlerStop
+
+
+async def prune_processed_updates():
+    while True:
+        if is_leader():
+            try:
+                coordination.prune(_wall_clock() - UPDATE_DEDUPE_TTL_HOURS * 3600)
+            except sqlite3.Error as e:
+                logging.error(f"Errore pulizia update gestiti: {e}")
+        await asyncio.sleep(3600)
+
+
+# ---------------------- LIMITI DI FREQUENZA ----------------------
+# Token bucket per utente e per chat, controllati prima degli handler (gruppo -1):
+# un comando scartato non tocca DB, Telegram o Finnhub. Ogni comando ha un costo; i
+# bucket inattivi da abbastanza tempo da essere di nuovo pieni vengono eliminati.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT", "1") != "0"
+USER_BUCKET = (10, 0.5)       # capacità, token ricaricati al secondo
+CHAT_BUCKET = (60, 3.0)
+RATE_LIMIT_COSTS = {
+    "vincitore": 4, "admin": 4, "live": 2, "classifica": 2, "scommesse": 2,
+    "storico": 2, "export": 8, "whatif": 8, "testapi": 4,
+}
+RATE_LIMIT_EVICT_SECONDS = 60
+ADMIN_CACHE_SECONDS = 300
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+        self.warned = False
+
+    def refill(self, capacity, rate, now):
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class RateLimiter:
+    def __init__(self):
+        self.buckets = {}
+        self.last_evict = perf_counter()
+
+    def allow(self, specs, cost, now=None):
+        """specs: [(chiave, (capacità, ricarica))]. Consuma cost da tutti i bucket o da nessuno."""
+        now = perf_counter() if now is None else now
+        if now - self.last_evict > RATE_LIMIT_EVICT_SECONDS:
+            self.evict(now)
+        buckets = []
+        for key, (capacity, rate) in specs:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(capacity, now)
+            else:
+                bucket.refill(capacity, rate, now)
+            buckets.append(bucket)
+        if any(b.tokens < cost for b in buckets):
+            return False
+        for bucket in buckets:
+            bucket.tokens -= cost
+            bucket.warned = False
+        return True
+
+    def evict(self, now):
+        # Un bucket fermo da capacità/ricarica secondi è di nuovo pieno: equivale a non averlo.
+        for key, bucket in list(self.buckets.items()):
+            capacity, rate = CHAT_BUCKET if key[0] == "chat" else USER_BUCKET
+            if now - bucket.updated >= capacity / rate:
+                del self.buckets[key]
+        self.last_evict = now
+
+
+rate_limiter = RateLimiter()
+
+
+async def rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if not RATE_LIMIT_ENABLED or message is None or not (message.text or "").startswith("/"):
+        return
+    user = update.effective_user
+    if user is None or user.id == ADMIN_CHAT_ID:
+        return
+    command = message.text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+    specs = [(("user", user.id), USER_BUCKET), (("chat", update.effective_chat.id), CHAT_BUCKET)]
+    if rate_limiter.allow(specs, RATE_LIMIT_COSTS.get(command, 1)):
+        return
+    bucket = rate_limiter.buckets[("user", user.id)]
+    if not bucket.warned:
+        # Un solo avviso per raffica: i comandi successivi vengono scartati in silenzio.
+        bucket.warned = True
+        await message.reply_text("⏳ Troppi comandi, rallenta un attimo.")
+    logging.info(f"Comando /{command} scartato dal limitatore")
+    raise ApplicationHandlerStop
+
+
+_admin_cache = {}
+
+
+async def get_chat_admins(bot, chat_id):
+    """get_chat_administrators con cache di ADMIN_CACHE_SECONDS per chat."""
+    now = perf_counter()
+    cached = _admin_cache.get(chat_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    admins = await bot.get_chat_administrators(chat_id)
+    _admin_cache[chat_id] = (now + ADMIN_CACHE_SECONDS, admins)
+    return admins
+
+
 # ---------------------- REMINDER ----------------------
 REMINDER_OFFSETS = [
     (180, "Mancano 3 ore"),
@@ -949,9 +3091,43 @@ REMINDER_OFFSETS = [
     (10,  "Mancano 10 minuti"),
 ]
 
-async def reminder_tick(context: ContextTypes.DEFAULT_TYPE):
-    """Usato se JobQueue è disponibile."""
-    now = datetime.now(ITALY_TZ)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def batch_messages(header, items, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Mette header e gli elementi (separati da spazi) nel minor numero di messaggi sotto limit."""
+    messages, current = [], header
+    for item in items:
+        separator = "\n" if current == header else " "
+        if len(current) + len(separator) + len(item) > limit:
+            messages.append(current)
+            current, separator = "", ""
+        current += separator + item
+    messages.append(current)
+    return messages
+
+
+def _reminder_messages(label, target_date):
+    cutoff_str = f"{CUTOFF_TIME.hour:02d}:{CUTOFF_TIME.minute:02d}"
+    try:
+        day = get_day_state(target_date)
+        count, pending = day.count, list(day.pending.values())
+    except Exception as e:
+        logging.error(f"Errore DB nel reminder: {e}")
+        count, pending = "non disponibile", []
+    header = (
+        f"🔔 {label}: il termine delle scommesse è alle {cutoff_str}.\n"
+        f"Finora {count} scommesse per il {target_date}.\n"
+        f"Usa /scommesse per scoprire chi non è una fighetta!"
+    )
+    mentions = [f"@{html.escape(uname)}" for uname in pending if uname]
+    if not mentions:
+        return [header]
+    return batch_messages(f"{header}\n\n⏰ Mancano ancora:", mentions)
+
+
+async def send_due_reminders(bot, now):
+    """Invia i reminder il cui minuto è arrivato; il leader li prende una sola volta per data/orario."""
     if now.weekday() in [5, 6]:
         return
     cutoff = now.replace(hour=CUTOFF_TIME.hour, minute=CUTOFF_TIME.minute, second=0, microsecond=0)
@@ -959,71 +3135,29 @@ async def reminder_tick(context: ContextTypes.DEFAULT_TYPE):
         tomorrow = now + timedelta(days=1)
         cutoff = tomorrow.replace(hour=CUTOFF_TIME.hour, minute=CUTOFF_TIME.minute, second=0, microsecond=0)
     target_date = cutoff.strftime("%Y-%m-%d")
-    if target_date in CHIUSURE_MERCATO:
+    if target_date in CHIUSURE_MERCATO or not is_leader():
         return
-    bot_state = context.application.bot_data
-    sent_reminders = bot_state.setdefault("sent_reminders", {})
-    already = sent_reminders.setdefault(target_date, set())
     for offset, label in REMINDER_OFFSETS:
-        if offset in already:
-            continue
         reminder_time = cutoff - timedelta(minutes=offset)
-        if reminder_time <= now < reminder_time + timedelta(minutes=1):
-            try:
-                c.execute("SELECT COUNT(*) FROM predictions WHERE date = ?", (target_date,))
-                count = c.fetchone()[0]
-            except Exception as e:
-                logging.error(f"Errore DB nel reminder: {e}")
-                count = "non disponibile"
-            cutoff_str = f"{CUTOFF_TIME.hour:02d}:{CUTOFF_TIME.minute:02d}"
-            message = (
-                f"🔔 {label}: il termine delle scommesse è alle {cutoff_str}.\n"
-                f"Finora {count} scommesse per il {target_date}.\n"
-                f"Usa /scommesse per scoprire chi non è una fighetta!"
-            )
+        if not (reminder_time <= now < reminder_time + timedelta(minutes=1)):
+            continue
+        if not coordination.claim(f"reminder:{target_date}:{offset}"):
+            continue
+        for message in _reminder_messages(label, target_date):
             try:
-                await context.bot.send_message(chat_id=GROUP_TOPIC_CHAT_ID, text=message, parse_mode=ParseMode.HTML)
+                await bot.send_message(chat_id=GROUP_TOPIC_CHAT_ID, text=message, parse_mode=ParseMode.HTML)
             except Exception as e:
                 logging.error(f"Errore invio reminder: {e}")
-            already.add(offset)
+
+async def reminder_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Usato se JobQueue è disponibile."""
+    await send_due_reminders(context.bot, datetime.now(ITALY_TZ))
 
 async def reminder_scheduler(application: Application):
     """Fallback automatico se JobQueue non è disponibile."""
     while True:
         try:
-            now = datetime.now(ITALY_TZ)
-            if now.weekday() in [5, 6]:
-                await asyncio.sleep(60); continue
-            cutoff = now.replace(hour=CUTOFF_TIME.hour, minute=CUTOFF_TIME.minute, second=0, microsecond=0)
-            if now > cutoff:
-                tomorrow = now + timedelta(days=1)
-                cutoff = tomorrow.replace(hour=CUTOFF_TIME.hour, minute=CUTOFF_TIME.minute, second=0, microsecond=0)
-            target_date = cutoff.strftime("%Y-%m-%d")
-            if target_date in CHIUSURE_MERCATO:
-                await asyncio.sleep(60); continue
-            sent = application.bot_data.setdefault("sent_reminders", {}).setdefault(target_date, set())
-            for offset, label in REMINDER_OFFSETS:
-                if offset in sent:
-                    continue
-                reminder_time = cutoff - timedelta(minutes=offset)
-                if reminder_time <= now < reminder_time + timedelta(minutes=1):
-                    try:
-                        c.execute("SELECT COUNT(*) FROM predictions WHERE date = ?", (target_date,))
-                        count = c.fetchone()[0]
-                    except Exception as e:
-                        logging.error(f"Errore DB nel reminder: {e}")
-                        count = "non disponibile"
-                    cutoff_str = f"{CUTOFF_TIME.hour:02d}:{CUTOFF_TIME.minute:02d}"
-                    message = (
-                        f"🔔 {label}: il termine delle scommesse è alle {cutoff_str}.\n"
-                        f"Finora {count} scommesse per il {target_date}.\n"
-                        f"Usa /scommesse per scoprire chi non è una fighetta!"
-                    )
-                    try:
-                        await application.bot.send_message(chat_id=GROUP_TOPIC_CHAT_ID, text=message, parse_mode=ParseMode.HTML)
-                    except Exception as e:
-                        logging.error(f"Errore invio reminder: {e}")
-                    sent.add(offset)
+            await send_due_reminders(application.bot, datetime.now(ITALY_TZ))
             await asyncio.sleep(30)
         except Exception as e:
             logging.error(f"Reminder loop error: {e}")
@@ -1031,7 +3165,13 @@ async def reminder_scheduler(application: Application):
 
 async def _post_init(application: Application):
     """Eseguito dopo l'inizializzazione: attiva JobQueue se presente, altrimenti fallback."""
+    get_day_state(datetime.now(ITALY_TZ).strftime("%Y-%m-%d"))
+    asyncio.create_task(loop_heartbeat())
+    asyncio.create_task(leader_election())
+    asyncio.create_task(prune_processed_updates())
     asyncio.create_task(keep_alive_ping())
+    asyncio.create_task(live_quote_poller())
+    asyncio.create_task(scoreboard_updater(application))
     jq = getattr(application, "job_queue", None)
     if jq is None:
         logging.info("JobQueue non disponibile: uso il fallback asyncio.")
@@ -1044,13 +3184,28 @@ async def _post_init(application: Application):
             logging.error(f"Impossibile avviare JobQueue, passo al fallback. Dettagli: {e}")
             asyncio.create_task(reminder_scheduler(application))
 
+async def _post_shutdown(application: Application):
+    coordination.release_lease("leader", WORKER_ID)
+
 # ---------------------- BOOTSTRAP ----------------------
-def main():
-    application: Application = ApplicationBuilder().token(TOKEN).post_init(_post_init).build()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
 
+def build_application(token=TOKEN, base_url=None) -> Application:
+    """Crea l'Application con tutti gli handler registrati (usata anche da loadtest.py)."""
+    builder = ApplicationBuilder().token(token).post_init(_post_init).post_shutdown(_post_shutdown)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application: Application = builder.build()
+
+    application.add_handler(TypeHandler(Update, claim_update), group=-2)
+    application.add_handler(TypeHandler(Update, rate_limit), group=-1)
     application.add_handler(CommandHandler("bet", bet))
     application.add_handler(CommandHandler("vincitore", vincitore))
     application.add_handler(CommandHandler("scommesse", scommesse))
+    application.add_handler(CommandHandler("live", live))
     application.add_handler(CommandHandler("classifica", classifica))
     application.add_handler(CommandHandler("bilancio", bilancio))
     application.add_handler(CommandHandler("istruzioni", istruzioni))
@@ -1065,14 +3220,161 @@ def main():
     application.add_handler(CommandHandler("chatid", chatid))
     application.add_handler(CommandHandler("tesoretto", tesoretto))
     application.add_handler(CommandHandler("betTEST", betTEST))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("storico", storico))
+    application.add_handler(CommandHandler("export", export))
+    application.add_handler(CommandHandler("backup", backup))
+    application.add_handler(CommandHandler("tabellone", tabellone))
+    application.add_handler(CommandHandler("regole", regole))
+    application.add_handler(CommandHandler("whatif", whatif))
+    application.add_handler(CommandHandler("profile", profile))
+    application.add_handler(CommandHandler("ricalcola_stats", ricalcola_stats))
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CommandHandler):
+                handler.callback = instrument_handler(min(handler.commands), handler.callback)
+    threading.Thread(target=_slow_handler_watch, name="slow-handler-watch", daemon=True).start()
+    return application
+
 
-    logging.info("Bot avviato con successo!")
+def main():
+    application = build_application()
+
+    logging.info(f"Bot avviato con successo! (worker {WORKER_ID})")
+    if WEBHOOK_URL:
+        # Con più worker dietro lo stesso URL non si scartano gli update pendenti:
+        # li gestisce chi li riceve, e claim_update evita i doppioni.
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            close_loop=False,
+        )
+        return
     application.run_polling(
         allowed_updates=Update.ALL_TYPES,
         drop_pending_updates=True,
         close_loop=False
     )
 
+# ---------------------- CLI ----------------------
+def _cli_export(args):
+    output = args.output or f"gme_export_{args.date_from}_{args.date_to}.{args.format}.gz"
+    if output == "-":
+        count = write_export(sys.stdout.buffer, args.date_from, args.date_to, args.format)
+    else:
+        with open(output, "wb") as fh:
+            count = write_export(fh, args.date_from, args.date_to, args.format)
+    logging.info(f"Export completato: {count} righe in {output}")
+    return 0
+
+
+def _cli_migrate(args):
+    report = apply_db_migrations(conn, dry_run=args.dry_run)
+    for filename, deltas in report.items():
+        print(f"{filename}: {len(deltas)} saldi modificati")
+        for uid, uname, before, after in deltas:
+            delta = round((after or 0) - (before or 0), 2)
+            print(f"  @{uname} ({uid}): {before} → {after} ({delta:+.2f})")
+    if args.dry_run and not report:
+        print("Nessuno script in attesa.")
+    return 0
+
+
+def _cli_whatif(args):
+    rules = Path(args.rules).read_text(encoding="utf-8") if Path(args.rules).is_file() else args.rules
+    days, report = whatif_report(args.date_from, args.date_to, json.loads(rules))
+    print(f"{days} giornate (tesoretto escluso)")
+    for uname, actual, alt in report:
+        print(f"{uname:<24}{actual:>12.2f}{alt:>12.2f}{alt - actual:>+12.2f}")
+    return 0
+
+
+def _cli_replay(args):
+    if args.fetch_missing or not args.no_cache_refresh:
+        fetched, missing = refresh_close_cache(fetch_missing=args.fetch_missing)
+        if fetched or missing:
+            logging.info(f"Chiusure scaricate: {fetched}, non disponibili: {missing}")
+    start = datetime.now().timestamp()
+    replay = replay_settlements(since=args.since, until=args.until)
+    elapsed = datetime.now().timestamp() - start
+    diff = replay_diff(replay)
+    print(f"{replay['days']} giornate rigiocate in {elapsed * 1000:.0f} ms; tesoretto rigiocato {replay['pot']:.2f}€ "
+          f"(attuale {get_unassigned_pot():.2f}€)")
+    if replay["missing"]:
+        print(f"Giornate senza chiusura in cache (saltate): {', '.join(replay['missing'])}")
+    print(f"{len(diff)} saldi diversi")
+    for uid, uname, replayed, current in diff:
+        print(f"{uname or uid:<24}{replayed:>12.2f}{current:>12.2f}{current - replayed:>+12.2f}")
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["user_id", "username", "replayed", "balance", "diff"])
+            writer.writerows((uid, uname, replayed, current, round(current - replayed, 2)) for uid, uname, replayed, current in diff)
+    return 1 if diff else 0
+
+
+def _cli_backup(args):
+    print(backup_database(args.label))
+    return 0
+
+
+def _cli_restore(args):
+    restore_database(args.snapshot, verify=not args.no_verify)
+    return 0
+
+
+def run_cli(argv):
+    """Senza argomenti avvia il bot; altrimenti esegue un comando di manutenzione."""
+    parser = argparse.ArgumentParser(description="GME PredictorBot")
+    commands = parser.add_subparsers(dest="command")
+
+    p_export = commands.add_parser("export", help="esporta previsioni, risultati e saldi (gzip)")
+    p_export.add_argument("date_from", help="data iniziale YYYY-MM-DD")
+    p_export.add_argument("date_to", help="data finale YYYY-MM-DD")
+    p_export.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    p_export.add_argument("--output", "-o", help="file di destinazione ('-' per stdout)")
+    p_export.set_defaults(func=_cli_export)
+
+    p_migrate = commands.add_parser("migrate", help="applica gli script di db_updates")
+    p_migrate.add_argument("--dry-run", action="store_true", help="mostra le variazioni dei saldi senza applicare")
+    p_migrate.set_defaults(func=_cli_migrate)
+
+    p_whatif = commands.add_parser("whatif", help="ricalcola un intervallo con regole alternative (sola lettura)")
+    p_whatif.add_argument("date_from", help="data iniziale YYYY-MM-DD")
+    p_whatif.add_argument("date_to", help="data finale YYYY-MM-DD")
+    p_whatif.add_argument("--rules", default="{}", help="JSON o file JSON con le regole da sostituire")
+    p_whatif.set_defaults(func=_cli_whatif)
+
+    p_replay = commands.add_parser("replay", help="ricostruisce i saldi dalle previsioni e li confronta con balances")
+    p_replay.add_argument("--since", help="parte dai saldi salvati dopo la giornata indicata (balance_snapshots)")
+    p_replay.add_argument("--until", help="ultima giornata da rigiocare (default: tutte)")
+    p_replay.add_argument("--fetch-missing", action="store_true", help="scarica da Finnhub le chiusure mancanti")
+    p_replay.add_argument("--no-cache-refresh", action="store_true", help="usa solo gme_closes così com'è")
+    p_replay.add_argument("-o", "--output", help="scrive le differenze in un file CSV")
+    p_replay.set_defaults(func=_cli_replay)
+
+    p_backup = commands.add_parser("backup", help="salva uno snapshot compresso del database")
+    p_backup.add_argument("--label", help="suffisso del nome file")
+    p_backup.set_defaults(func=_cli_backup)
+
+    p_restore = commands.add_parser("restore", help="ripristina il database da uno snapshot (a bot fermo)")
+    p_restore.add_argument("snapshot", help="file predictions-*.db.gz")
+    p_restore.add_argument("--no-verify", action="store_true", help="non confrontare i saldi dopo il ripristino")
+    p_restore.set_defaults(func=_cli_restore)
+
+    args = parser.parse_args(argv)
+    if args.command != "migrate":
+        apply_db_migrations(conn)
+    if args.command is None:
+        start_keep_alive_server()
+        main()
+        return 0
+    return args.func(args)
+
 if __name__ == "__main__":
-    start_keep_alive_server()
-    main()
\ No newline at end of file
+    sys.exit(run_cli(sys.argv[1:]))
@@ -0,0 +1,373 @@
+"""Load test offline del bot: finto Bot API Telegram + finto Finnhub.
+
+Esegue migliaia di update /bet, /scommesse, /classifica e /vincitore attraverso
+l'Application reale (polling su getUpdates) contro un database temporaneo e
+riporta update/s, percentili di latenza per handler e attese di lock su SQLite.
+
+Uso:
+    python3 loadtest.py --updates 4000 --users 40 --lock-contention
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from zoneinfo import ZoneInfo
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "GME Load", "username": "gme_load_bot"}
+ITALY_TZ = ZoneInfo("Europe/Rome")
+NY_TZ = ZoneInfo("America/New_York")
+LOCK_WAIT_MS = 5.0
+
+
+# ---------------------- FINTO BOT API ----------------------
+class FakeBotApi:
+    """Coda di update servita da getUpdates e contatori dei metodi in uscita."""
+
+    def __init__(self):
+        self.updates = deque()
+        self.cond = threading.Condition()
+        self.calls = defaultdict(int)
+        self.next_message_id = 1_000_000
+
+    def push(self, updates):
+        with self.cond:
+            self.updates.extend(updates)
+            self.cond.notify_all()
+
+    def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), 0.5)
+        with self.cond:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            if not self.updates and timeout:
+                self.cond.wait(timeout)
+            return [self.updates[i] for i in range(min(limit, len(self.updates)))]
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return self.get_updates(params)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            self.next_message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": self.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "user": BOT_USER, "is_anonymous": False}]
+        return True
+
+
+def _make_bot_api_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1]
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode("utf-8") if length else ""
+            if "json" in (self.headers.get("Content-Type") or ""):
+                params = json.loads(body or "{}")
+            else:
+                params = {k: v[0] for k, v in parse_qs(body).items()}
+            payload = json.dumps({"ok": True, "result": api.handle(method, params)}).encode("utf-8")
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            except (BrokenPipeError, ConnectionResetError):
+                # long polling interrotto allo spegnimento dell'Updater
+                pass
+
+        do_GET = do_POST
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+# ---------------------- FINTO FINNHUB ----------------------
+def _make_finnhub_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            state["calls"] += 1
+            pct = state["close_pct"]
+            day = state["day"]
+            if url.path.endswith("/quote"):
+                ts = datetime(day.year, day.month, day.day, 16, 0, tzinfo=NY_TZ).timestamp()
+                data = {"c": round(100 * (1 + pct / 100), 4), "pc": 100.0, "t": int(ts)}
+            else:
+                ts_prev = datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() - 86400
+                data = {
+                    "s": "ok",
+                    "t": [int(ts_prev), int(ts_prev) + 86400],
+                    "c": [100.0, round(100 * (1 + pct / 100), 4)],
+                }
+            payload = json.dumps(data).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def _serve(handler_cls):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_cls)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---------------------- STRUMENTAZIONE ----------------------
+class _FrozenDatetime(datetime):
+    """datetime con now() controllato dal driver, per simulare le fasi della giornata."""
+
+    frozen = None
+
+    @classmethod
+    def now(cls, tz=None):
+        if tz is None:
+            return cls.frozen.replace(tzinfo=None)
+        return cls.frozen.astimezone(tz)
+
+
+class _TimedDb:
+    """Proxy su cursore/connessione che misura il tempo passato dentro SQLite."""
+
+    def __init__(self, target, stats, methods):
+        self._target = target
+        self._stats = stats
+        self._methods = methods
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in self._methods:
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                self._stats["calls"] += 1
+                self._stats["time_ms"] += elapsed
+                if elapsed >= LOCK_WAIT_MS:
+                    self._stats["lock_waits"] += 1
+                    self._stats["lock_wait_ms"] += elapsed
+
+        return timed
+
+
+def _contention_writer(db_path, stop, hold_ms, interval_ms):
+    """Scrittore esterno che tiene il lock di scrittura, come uno script db_updates."""
+    other = sqlite3.connect(db_path, isolation_level=None)
+    other.execute("PRAGMA busy_timeout=5000;")
+    while not stop.is_set():
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("UPDATE balances SET balance = balance WHERE user_id = -1")
+        time.sleep(hold_ms / 1000)
+        other.execute("COMMIT")
+        time.sleep(interval_ms / 1000)
+    other.close()
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+# ---------------------- DRIVER ----------------------
+def _command_update(update_id, user_id, text, chat_id):
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "GME load"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"U{user_id}", "username": f"user{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def _build_phase(start_id, count, users, commands, rng, chat_id):
+    updates = []
+    for i in range(count):
+        user_id = rng.choice(users)
+        command = rng.choices([cmd for cmd, _ in commands], weights=[w for _, w in commands])[0]
+        if command == "/bet":
+            command = f"/bet {rng.uniform(-5, 5):.2f}"
+        updates.append(_command_update(start_id + i, user_id, command, chat_id))
+    return updates
+
+
+async def _run(args):
+    bot_api = FakeBotApi()
+    bot_server = _serve(_make_bot_api_handler(bot_api))
+    finnhub_state = {"calls": 0, "close_pct": args.close, "day": None}
+    finnhub_server = _serve(_make_finnhub_handler(finnhub_state))
+
+    workdir = tempfile.mkdtemp(prefix="gme-loadtest-")
+    db_path = os.path.join(workdir, "predictions.db")
+    os.environ["PREDICTIONS_DB"] = db_path
+    os.environ["TELEGRAM_BOT_TOKEN"] = FAKE_TOKEN
+    os.environ["FINNHUB_API_KEY"] = "loadtest"
+    os.environ["FINNHUB_BASE_URL"] = f"http://127.0.0.1:{finnhub_server.server_address[1]}/api/v1"
+    os.environ.pop("KEEPALIVE_URL", None)
+    os.environ.pop("RENDER_EXTERNAL_URL", None)
+    # Pochi utenti simulati inviano migliaia di comandi: il limitatore li scarterebbe.
+    os.environ["RATE_LIMIT"] = "0"
+
+    import GME_TelegramBot as bot
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    bot.datetime = _FrozenDatetime
+    day = datetime.strptime(args.day, "%Y-%m-%d").date()
+    finnhub_state["day"] = day
+
+    rng = random.Random(args.seed)
+    users = list(range(10_000, 10_000 + args.users))
+    bot.c.executemany(
+        "INSERT OR IGNORE INTO balances (user_id, username, balance) VALUES (?, ?, 0)",
+        [(uid, f"user{uid}") for uid in users],
+    )
+    bot.conn.commit()
+
+    db_stats = defaultdict(float)
+    bot.c = _TimedDb(bot.c, db_stats, {"execute", "executemany", "fetchone", "fetchall"})
+    bot.conn = _TimedDb(bot.conn, db_stats, {"commit", "execute", "rollback"})
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    processed = {"count": 0, "target": 0}
+    done = asyncio.Event()
+
+    application = bot.build_application(token=FAKE_TOKEN, base_url=f"http://127.0.0.1:{bot_server.server_address[1]}/bot")
+    for handler in application.handlers[0]:
+        original = handler.callback
+        name = sorted(handler.commands)[0]
+
+        async def timed(update, context, _original=original, _name=name):
+            start = time.perf_counter()
+            try:
+                return await _original(update, context)
+            except Exception:
+                errors[_name] += 1
+                raise
+            finally:
+                latencies[_name].append((time.perf_counter() - start) * 1000)
+                processed["count"] += 1
+                if processed["count"] >= processed["target"]:
+                    done.set()
+
+        handler.callback = timed
+
+    stop_contention = threading.Event()
+    if args.lock_contention:
+        threading.Thread(
+            target=_contention_writer,
+            args=(db_path, stop_contention, args.hold_ms, args.interval_ms),
+            daemon=True,
+        ).start()
+
+    phases = [
+        ("apertura 12:00", datetime(day.year, day.month, day.day, 12, 0, tzinfo=ITALY_TZ),
+         [("/bet", 6), ("/scommesse", 2), ("/classifica", 2)]),
+        ("chiusura 22:30", datetime(day.year, day.month, day.day, 22, 30, tzinfo=ITALY_TZ),
+         [("/vincitore", 4), ("/scommesse", 3), ("/classifica", 3)]),
+    ]
+    per_phase = args.updates // len(phases)
+    next_id = 1
+    report = []
+
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=1)
+        for label, frozen, commands in phases:
+            _FrozenDatetime.frozen = frozen
+            for key in list(latencies):
+                latencies[key].clear()
+            db_before = dict(db_stats)
+            sent_before = bot_api.calls["sendMessage"]
+            processed["target"] = processed["count"] + per_phase
+            done.clear()
+            updates = _build_phase(next_id, per_phase, users, commands, rng, bot.GROUP_TOPIC_CHAT_ID)
+            next_id += per_phase
+            started = time.perf_counter()
+            bot_api.push(updates)
+            await asyncio.wait_for(done.wait(), timeout=args.timeout)
+            elapsed = time.perf_counter() - started
+            report.append((label, elapsed, {k: sorted(v) for k, v in latencies.items() if v},
+                           {k: db_stats[k] - db_before.get(k, 0) for k in ("calls", "time_ms", "lock_waits", "lock_wait_ms")},
+                           bot_api.calls["sendMessage"] - sent_before))
+        await application.updater.stop()
+        await application.stop()
+
+    stop_contention.set()
+    bot_server.shutdown()
+    finnhub_server.shutdown()
+
+    for label, elapsed, lat, db, sent in report:
+        print(f"\n=== Fase {label}: {per_phase} update in {elapsed:.2f}s ({per_phase / elapsed:.1f} update/s) ===")
+        print(f"{'comando':<12}{'n':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, values in sorted(lat.items()):
+            print(f"{name:<12}{len(values):>7}{_percentile(values, 50):>10.2f}{_percentile(values, 90):>10.2f}"
+                  f"{_percentile(values, 99):>10.2f}{values[-1]:>10.2f}")
+        print(f"DB: {int(db['calls'])} chiamate, {db['time_ms']:.1f} ms totali, "
+              f"{int(db['lock_waits'])} attese di lock (≥{LOCK_WAIT_MS:.0f} ms) per {db['lock_wait_ms']:.1f} ms")
+        print(f"Messaggi inviati: {sent}")
+    print(f"\nErrori handler: {dict(errors) or 'nessuno'}")
+    print(f"Chiamate Finnhub: {finnhub_state['calls']}, chiamate Bot API: {dict(bot_api.calls)}")
+    print(f"Database temporaneo: {db_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test offline del GME PredictorBot")
+    parser.add_argument("--updates", type=int, default=4000, help="update totali da inviare")
+    parser.add_argument("--users", type=int, default=40, help="numero di giocatori simulati")
+    parser.add_argument("--day", default="2026-06-30", help="giorno di mercato simulato (YYYY-MM-DD)")
+    parser.add_argument("--close", type=float, default=1.23, help="variazione %% restituita dal finto Finnhub")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--lock-contention", action="store_true", help="avvia uno scrittore concorrente sul DB")
+    parser.add_argument("--hold-ms", type=float, default=20.0, help="durata del lock dello scrittore concorrente")
+    parser.add_argument("--interval-ms", type=float, default=100.0, help="pausa tra due lock dello scrittore")
+    parser.add_argument("--timeout", type=float, default=600.0, help="timeout per fase in secondi")
+    parser.add_argument("--verbose", action="store_true")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import time
 import logging
 import requests
 import os
+import signal
 import subprocess
 
 # Configurazione logging
@@ -12,45 +13,109 @@ logging.basicConfig(
 )
 
 BOT_SCRIPT = "GME_TelegramBot.py"
-HEALTH_URL = "http://localhost:8080/health"
 CHECK_INTERVAL = 300  # 5 minuti
+# Con WORKERS > 1 ogni worker ha la sua porta per /health (BASE_PORT + n), la sua
+# porta webhook (WEBHOOK_PORT + n), il suo pidfile e i suoi log. Più worker
+# richiedono WEBHOOK_URL: in polling Telegram accetta un solo consumatore.
+WORKERS = int(os.getenv("WORKERS", "1"))
+BASE_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Il bot scrive i suoi log JSON in LOG_FILE con rotazione propria; qui finisce solo
+# l'output non gestito dal logging (es. traceback di un crash), ruotato a ogni riavvio.
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
 
-def is_bot_running():
+def rotate_log(path):
+    if not os.path.exists(path) or os.path.getsize(path) < LOG_MAX_BYTES:
+        return
+    for i in range(LOG_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{path}.{i}"):
+            os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+    os.replace(path, f"{path}.1")
+
+def _worker_file(path, worker):
+    if WORKERS == 1:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}-{worker}{ext}"
+
+def _pidfile(worker):
+    return _worker_file("bot.pid", worker)
+
+def is_bot_running(worker=0):
     try:
-        response = requests.get(HEALTH_URL, timeout=10)
+        response = requests.get(f"http://localhost:{BASE_PORT + worker}/health", timeout=10)
         if response.status_code == 200:
-            logging.info(f"Bot attivo: {response.json()}")
+            logging.info(f"Worker {worker} attivo: {response.json()}")
             return True
     except Exception as e:
-        logging.error(f"Errore nel controllo dello stato del bot: {e}")
+        logging.error(f"Errore nel controllo dello stato del worker {worker}: {e}")
     return False
 
-def restart_bot():
-    logging.warning("Riavvio del bot in corso...")
+def stop_bot(worker=0):
+    """Termina solo il processo registrato nel pidfile del worker, non tutti i bot."""
     try:
-        # Trova e termina solo il processo del bot, non tutti i processi Python
-        os.system(f"pkill -f {BOT_SCRIPT}")
-        time.sleep(5)  # Attendi che i processi terminino
-        
-        # Avvia il bot in background con nohup per mantenerlo attivo
-        with open("bot.log", "a") as log_file:
+        with open(_pidfile(worker)) as fh:
+            pid = int(fh.read().strip())
+    except (OSError, ValueError):
+        if WORKERS == 1:
+            # Nessun pidfile (bot avviato da una versione precedente): vecchio comportamento.
+            os.system(f"pkill -f {BOT_SCRIPT}")
+            time.sleep(5)
+        return
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    for _ in range(10):
+        time.sleep(1)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+    os.killpg(pid, signal.SIGKILL)
+
+def restart_bot(worker=0):
+    logging.warning(f"Riavvio del worker {worker} in corso...")
+    try:
+        stop_bot(worker)
+
+        # Avvia il bot in background in una nuova sessione per mantenerlo attivo
+        stderr_log = _worker_file("bot.stderr.log", worker)
+        rotate_log(stderr_log)
+        env = {
+            **os.environ,
+            "LOG_FILE": _worker_file(LOG_FILE, worker),
+            "PORT": str(BASE_PORT + worker),
+            "WEBHOOK_PORT": str(WEBHOOK_PORT + worker),
+            "WORKER_ID": f"worker-{worker}",
+        }
+        with open(stderr_log, "a") as log_file:
             process = subprocess.Popen(
                 ["python3", BOT_SCRIPT],
                 stdout=log_file,
                 stderr=log_file,
+                env=env,
                 start_new_session=True
             )
-        logging.info(f"Bot riavviato con successo (PID: {process.pid})")
+        with open(_pidfile(worker), "w") as fh:
+            fh.write(str(process.pid))
+        logging.info(f"Worker {worker} riavviato con successo (PID: {process.pid})")
     except Exception as e:
-        logging.error(f"Errore nel riavvio del bot: {e}")
+        logging.error(f"Errore nel riavvio del worker {worker}: {e}")
 
 def main():
-    logging.info("Script di monitoraggio avviato")
-    
+    logging.info(f"Script di monitoraggio avviato ({WORKERS} worker)")
+    if WORKERS > 1 and not os.getenv("WEBHOOK_URL"):
+        logging.error("Più worker richiedono WEBHOOK_URL: in polling Telegram accetta un solo consumatore.")
+        return
+
     while True:
-        if not is_bot_running():
-            logging.warning("Bot non attivo - avvio riavvio")
-            restart_bot()
+        for worker in range(WORKERS):
+            if not is_bot_running(worker):
+                logging.warning(f"Worker {worker} non attivo - avvio riavvio")
+                restart_bot(worker)
         
         # Attendi prima del prossimo controllo
         time.sleep(CHECK_INTERVAL)
@@ -0,0 +1,65 @@
+"""Test offline di backup e ripristino su un database temporaneo.
+
+Crea un DB temporaneo, salva due snapshot con saldi diversi, modifica i saldi e
+ripristina ciascuno snapshot controllando che tornino i saldi salvati. Con BACKUP_KEEP=2
+il primo ripristino riguarda lo snapshot più vecchio, che la rotazione del backup
+"pre-restore" elimina.
+
+Uso:
+    python3 restoretest.py
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+BALANCES = [(1, "alice", 120.5), (2, "bob", -35.0), (3, "carol", 0.0)]
+
+
+def main():
+    work_dir = Path(tempfile.mkdtemp(prefix="gme-restoretest-"))
+    os.environ["PREDICTIONS_DB"] = str(work_dir / "predictions.db")
+    os.environ["BACKUP_DIR"] = str(work_dir / "backups")
+    os.environ["BACKUP_KEEP"] = "2"
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:RESTORETEST")
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import GME_TelegramBot as bot
+
+    def balances():
+        return bot.conn.execute("SELECT user_id, username, balance FROM balances ORDER BY user_id").fetchall()
+
+    def set_balances(rows):
+        bot.c.execute("DELETE FROM balances")
+        bot.c.executemany("INSERT INTO balances (user_id, username, balance) VALUES (?, ?, ?)", rows)
+        bot.conn.commit()
+
+    failures = []
+
+    def check(label, expected):
+        actual = balances()
+        print(f"{label}: {'ok' if actual == expected else 'ERRORE'}")
+        if actual != expected:
+            failures.append(f"{label}: attesi {expected}, trovati {actual}")
+
+    set_balances(BALANCES)
+    first = bot.backup_database("one")
+    changed = [(uid, uname, bal + 100) for uid, uname, bal in BALANCES] + [(4, "dave", 10.0)]
+    set_balances(changed)
+    second = bot.backup_database("two")
+    set_balances([(9, "zed", 1.0)])
+
+    # first è il più vecchio e BACKUP_KEEP è già raggiunto: il backup "pre-restore" lo ruota via.
+    bot.restore_database(first)
+    check("Ripristino dello snapshot più vecchio", BALANCES)
+    bot.restore_database(second)
+    check("Ripristino dello snapshot successivo", changed)
+
+    print(f"Database temporaneo: {work_dir}")
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()